@@ -1,18 +1,31 @@
 # Standard Library
 import logging
 import os
+import shutil
 import time
 import json
 import asyncio
-from typing import Dict, List, Optional, Union, AsyncGenerator
+import bisect
+import gc
+import hashlib
+import hmac
+import inspect
+import sys
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Union, AsyncGenerator
 
 # Third-Party Libraries
 from fastapi import FastAPI, HTTPException, Request, Query, Body
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, DynamicCache, StaticCache
 import torch
-from prometheus_client import Counter, Histogram, start_http_server
+import transformers
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 # Configure logging
 logging.basicConfig(
@@ -25,21 +38,229 @@ logger = logging.getLogger(__name__)
 app = FastAPI(title="ML Inference Service", description="API for ML model inference")
 
 # Start Prometheus metrics server
-start_http_server(8000)
+# `python app.py` starts it in __main__ instead, once it knows whether several server
+# processes share it (they then write their metrics to PROMETHEUS_MULTIPROC_DIR)
+if __name__ != "__main__" and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    start_http_server(8000)
 
 # Define Prometheus metrics
 REQUESTS = Counter('ml_requests_total', 'Total number of requests processed', ['model'])
 TOKENS_PROCESSED = Counter('ml_tokens_processed_total', 'Total number of tokens processed', ['type', 'model'])
 PROCESSING_TIME = Histogram('ml_processing_seconds', 'Time spent processing requests', ['model'])
+WARMUP_SECONDS = Gauge('ml_warmup_seconds', 'Time spent warming up before serving', ['model'])
+PREFIX_CACHE_HITS = Counter('ml_prefix_cache_hits_total', 'Prompts that reused a cached KV prefix', ['model'])
+PREFIX_CACHE_MISSES = Counter('ml_prefix_cache_misses_total', 'Prompts with no cached KV prefix', ['model'])
+MODEL_MEMORY = Gauge('ml_model_memory_bytes', 'Memory held by model weights and buffers', ['model', 'quantization'])
+RESPONSE_CACHE_HITS = Counter('ml_response_cache_hits_total', 'Requests answered from the response cache', ['model'])
+RESPONSE_CACHE_MISSES = Counter('ml_response_cache_misses_total', 'Cacheable requests that had to run the model', ['model'])
+PREFIX_CACHE_TOKENS = Counter('ml_prefix_cache_tokens_reused_total', 'Prompt tokens served from the prefix cache', ['model'])
+SSE_CONNECTIONS = Gauge('ml_sse_connections', 'Open SSE connections on this replica')
+SSE_FANOUT_SECONDS = Histogram('ml_sse_fanout_seconds', 'Time from a notification being published to its SSE client receiving it',
+                               buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+SPECULATIVE_PROPOSED = Counter('ml_speculative_proposed_tokens_total', 'Draft tokens proposed for verification', ['model'])
+SPECULATIVE_ACCEPTED = Counter('ml_speculative_accepted_tokens_total', 'Draft tokens accepted by the main model', ['model'])
+SPECULATIVE_TOKENS_PER_FORWARD = Histogram('ml_speculative_tokens_per_forward', 'Tokens emitted per main model forward pass when speculating',
+                                           ['model'], buckets=(1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 16))
+AMQP_MESSAGES = Counter('ml_amqp_messages_total', 'Messages handled by the AMQP consumer', ['outcome'])
+# Labelled by budget: "stream" for streamed requests when they are admitted separately (see KV_CACHE_MAX_MB), else "default"
+ADMISSION_QUEUE_DEPTH = Gauge('ml_admission_queue_depth', 'Requests waiting for admission', ['budget'])
+ADMISSION_QUEUED_TOKENS = Gauge('ml_admission_queued_tokens', 'Estimated tokens of the requests waiting for admission', ['budget'])
+ADMISSION_ACTIVE_TOKENS = Gauge('ml_admission_active_tokens', 'Estimated tokens of the admitted requests still running', ['budget'])
+MODEL_LOADS = Counter('ml_model_loads_total', 'Times a model was loaded into memory', ['model'])
+MODEL_EVICTIONS = Counter('ml_model_evictions_total', 'Times a model was evicted to stay within the memory budget', ['model'])
+MODEL_LOAD_SECONDS = Histogram('ml_model_load_seconds', 'Time spent loading a model', ['model'],
+                               buckets=(.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+KV_CACHE_BUDGET_BYTES = Gauge('ml_kv_cache_budget_bytes', 'KV cache memory the batching engines of all models share')
+KV_CACHE_USED_BYTES = Gauge('ml_kv_cache_used_bytes', 'KV cache memory held by sequences of the batching engine', ['model'])
+PADDING_EFFICIENCY = Histogram('ml_padding_efficiency', 'Real over computed positions (left-padded past KV plus new tokens) per batched forward pass',
+                               ['model'], buckets=(.1, .2, .3, .4, .5, .6, .7, .8, .9, .95, 1))
+MODELS_LOADED = Gauge('ml_models_loaded', 'Models currently held in memory')
+ADMISSION_REJECTED = Counter('ml_admission_rejected_total', 'Requests shed by admission control', ['reason'])
+# Request stages, labelled by model and streaming ("true" for streamed responses, else "false").
+# Queue wait and time to first token count from when the tokenized request starts waiting for admission
+STAGE_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+WAIT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+TOKENIZATION_SECONDS = Histogram('ml_tokenization_seconds', 'Time spent tokenizing prompts',
+                                 ['model', 'streaming'], buckets=STAGE_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram('ml_queue_wait_seconds', 'Time a request waits before its prefill starts',
+                               ['model', 'streaming'], buckets=WAIT_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram('ml_time_to_first_token_seconds', 'Time until the first generated token',
+                                ['model', 'streaming'], buckets=WAIT_BUCKETS)
+DECODE_TOKEN_SECONDS = Histogram('ml_decode_token_seconds', 'Decode latency of each generated token after the first',
+                                 ['model', 'streaming'], buckets=STAGE_BUCKETS)
+DETOKENIZATION_SECONDS = Histogram('ml_detokenization_seconds', 'Time spent turning generated tokens into text, per request',
+                                   ['model', 'streaming'], buckets=STAGE_BUCKETS)
+SERIALIZATION_SECONDS = Histogram('ml_serialization_seconds', 'Time spent serializing a response or its stream chunks, per request',
+                                  ['model', 'streaming'], buckets=STAGE_BUCKETS)
+INFLIGHT_SEQUENCES = Gauge('ml_inflight_sequences', 'Sequences queued or decoding', ['model', 'streaming'])
+BATCH_SIZE = Gauge('ml_batch_size', 'Sequences in the latest decode step', ['model', 'streaming'])
 
 # Global state trackers
+# model_loaded flips once weights are in memory, model_ready once the service can take traffic
 model_loaded = False
-processing_request = False
+model_ready = False
+model_load_error: Optional[str] = None
+# With SERVER_PROCESSES > 1, one flag per server process shared with the parent; /ready waits for all of them
+server_processes_ready = None
 
 # Load model based on environment variable
 MODEL_NAME = os.environ.get("MODEL_NAME", "distilgpt2")
 logger.info(f"Loading model: {MODEL_NAME}")
 
+# Multi-model knobs
+# SERVED_MODELS lists further models a request may name; they load on first use and the least
+# recently used idle ones are evicted once loaded weights exceed MODEL_MEMORY_BUDGET_MB (0 = no limit).
+# MODEL_NAME is always loaded and never evicted
+SERVED_MODELS = [name.strip() for name in os.environ.get("SERVED_MODELS", "").split(",") if name.strip()]
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+
+# Directory for converted, memory-mappable model snapshots (empty disables snapshots)
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "")
+
+# Weight quantization applied at load: none | dynamic-int8 (CPU) | bf16
+QUANTIZATION = os.environ.get("QUANTIZATION", "none").lower()
+
+# Warmup knobs
+# Synthetic prompt lengths and concurrent batch sizes run before /ready flips
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+WARMUP_PROMPT_LENGTHS = [int(n) for n in os.environ.get("WARMUP_PROMPT_LENGTHS", "8,64,256").split(",") if n.strip()]
+WARMUP_BATCH_SIZES = [int(n) for n in os.environ.get("WARMUP_BATCH_SIZES", "1,4").split(",") if n.strip()]
+WARMUP_NEW_TOKENS = int(os.environ.get("WARMUP_NEW_TOKENS", "8"))
+# Optionally compile the single-token decode step with torch.compile
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "false").lower() in ("1", "true", "yes")
+TORCH_COMPILE_MODE = os.environ.get("TORCH_COMPILE_MODE", "default")
+
+# Speculative decoding knobs
+# DRAFT_MODEL_NAME is a small model sharing MODEL_NAME's tokenizer (empty disables speculation);
+# it proposes up to SPECULATIVE_TOKENS tokens that the main model verifies in one forward pass
+DRAFT_MODEL_NAME = os.environ.get("DRAFT_MODEL_NAME", "")
+SPECULATIVE_TOKENS = int(os.environ.get("SPECULATIVE_TOKENS", "4"))
+
+# Continuous batching knobs
+# MAX_BATCH_SIZE caps how many sequences decode together in one forward pass
+# MAX_QUEUE_WAIT_MS is how long an idle engine waits for more requests to fill the first batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "16"))
+MAX_QUEUE_WAIT_MS = float(os.environ.get("MAX_QUEUE_WAIT_MS", "10"))
+# Waiting sequences are bucketed by prompt length (LENGTH_BUCKETS token boundaries) and max new tokens
+# (NEW_TOKEN_BUCKETS); the batch is filled one bucket at a time, and a bucket that cannot fill it waits at
+# most LENGTH_BUCKET_MAX_WAIT_MS while other sequences decode. Forward passes also group rows by these bounds
+LENGTH_BUCKETS = [int(n) for n in os.environ.get("LENGTH_BUCKETS", "16,64,256").split(",") if n.strip()]
+NEW_TOKEN_BUCKETS = [int(n) for n in os.environ.get("NEW_TOKEN_BUCKETS", "32").split(",") if n.strip()]
+LENGTH_BUCKET_MAX_WAIT_MS = float(os.environ.get("LENGTH_BUCKET_MAX_WAIT_MS", "25"))
+# At most PREFILL_CHUNK_TOKENS prompt tokens are prefilled per engine step (shared by every new sequence) or per
+# streaming executor job, so long prompts are interleaved with decode steps (0 prefills whole prompts at once)
+PREFILL_CHUNK_TOKENS = int(os.environ.get("PREFILL_CHUNK_TOKENS", "256"))
+
+# Inference executor knobs
+# INFERENCE_WORKERS is the number of threads that run forward passes
+# INFERENCE_QUEUE_SIZE caps admitted requests (queued + running) before we answer 503
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "256"))
+RETRY_AFTER_SECONDS = os.environ.get("RETRY_AFTER_SECONDS", "1")
+
+# Admission control knobs
+# A request is estimated at its prompt tokens plus max_length per returned sequence. ADMISSION_TOKEN_BUDGET
+# estimated tokens run at once; further requests wait, shared fairly between user_ids, and are answered
+# 429 once ADMISSION_MAX_QUEUED_TOKENS are already waiting or after ADMISSION_MAX_WAIT_SECONDS
+ADMISSION_TOKEN_BUDGET = int(os.environ.get("ADMISSION_TOKEN_BUDGET", str(MAX_BATCH_SIZE * 256)))
+ADMISSION_MAX_QUEUED_TOKENS = int(os.environ.get("ADMISSION_MAX_QUEUED_TOKENS", str(MAX_BATCH_SIZE * 256 * 8)))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "30"))
+# user_id assumed for requests that carry none (same default as the ml-worker mapping)
+DEFAULT_USER_ID = "default-user"
+
+# Largest number of prompts accepted by /inference/batch (matches the ml-worker credit)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "64"))
+
+# Prefix cache knobs
+# Prompt prefixes are cached in PREFIX_CACHE_BLOCK_TOKENS blocks within PREFIX_CACHE_MAX_MB of KV memory
+PREFIX_CACHE_ENABLED = os.environ.get("PREFIX_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFIX_CACHE_BLOCK_TOKENS = int(os.environ.get("PREFIX_CACHE_BLOCK_TOKENS", "16"))
+PREFIX_CACHE_MAX_MB = float(os.environ.get("PREFIX_CACHE_MAX_MB", "256"))
+
+# Paged KV cache knobs
+# The batching engine reserves keys/values in KV_BLOCK_TOKENS-token pages of KV_CACHE_MAX_MB, one budget shared by
+# all loaded models and allocated as sequences run (0 keeps per-request cache tensors). Unless ADMISSION_TOKEN_BUDGET
+# is set, the admission budget is as many tokens as that budget holds, each model's tokens weighed by their KV size,
+# so as many sequences run as fit in memory. Streamed requests keep their cache in their own buffers, outside the
+# pages: with a KV budget they are admitted against a separate budget of as many tokens as STREAM_KV_CACHE_MAX_MB
+# holds, so KV memory stays within KV_CACHE_MAX_MB + STREAM_KV_CACHE_MAX_MB however many models are loaded
+KV_CACHE_MAX_MB = float(os.environ.get("KV_CACHE_MAX_MB", "512"))
+KV_BLOCK_TOKENS = int(os.environ.get("KV_BLOCK_TOKENS", "16"))
+STREAM_KV_CACHE_MAX_MB = float(os.environ.get("STREAM_KV_CACHE_MAX_MB", "256"))
+ADMISSION_BUDGET_FROM_KV_CACHE = "ADMISSION_TOKEN_BUDGET" not in os.environ
+
+# Response cache knobs
+# Reproducible or opted-in requests are cached for RESPONSE_CACHE_TTL_SECONDS, at most RESPONSE_CACHE_SIZE locally;
+# with RESPONSE_CACHE_USE_REDIS the cache is shared across replicas through REDIS_URL
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "300"))
+RESPONSE_CACHE_USE_REDIS = os.environ.get("RESPONSE_CACHE_USE_REDIS", "false").lower() in ("1", "true", "yes")
+
+# Redis connection shared by the features that use it (e.g. redis://:password@ml-redis-master:6379/0)
+REDIS_URL = os.environ.get("REDIS_URL", "")
+
+# Notification hub knobs
+# NOTIFY_BACKEND routes /notify to SSE clients on other replicas: redis (through REDIS_URL) or memory
+# (this process only); notifications wait NOTIFY_BUFFER_TTL_SECONDS for a client that is not connected yet
+NOTIFY_BACKEND = os.environ.get("NOTIFY_BACKEND", "redis" if REDIS_URL else "memory").lower()
+NOTIFY_BUFFER_TTL_SECONDS = float(os.environ.get("NOTIFY_BUFFER_TTL_SECONDS", "300"))
+# Largest number of notifications accepted by /notify/batch
+NOTIFY_BATCH_MAX_ITEMS = int(os.environ.get("NOTIFY_BATCH_MAX_ITEMS", "1000"))
+# Idle SSE connections get a ping every SSE_KEEPALIVE_SECONDS from one shared ticker
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "30"))
+
+# AMQP consumer knobs
+# With AMQP_CONSUMER_ENABLED the service consumes AMQP_REQUEST_QUEUE itself and publishes to
+# AMQP_RESULT_QUEUE in the ml-worker result schema; AMQP_PREFETCH unacked messages are held at once
+# (defaults to MAX_BATCH_SIZE). AMQP_BROKER is amqp (RABBITMQ_URL) or memory (in-process, for tests)
+AMQP_CONSUMER_ENABLED = os.environ.get("AMQP_CONSUMER_ENABLED", "false").lower() in ("1", "true", "yes")
+AMQP_BROKER = os.environ.get("AMQP_BROKER", "amqp").lower()
+RABBITMQ_URL = os.environ.get("RABBITMQ_URL", "")
+AMQP_REQUEST_QUEUE = os.environ.get("AMQP_REQUEST_QUEUE", "inference_requests")
+AMQP_RESULT_QUEUE = os.environ.get("AMQP_RESULT_QUEUE", "inference_results")
+AMQP_PREFETCH = int(os.environ.get("AMQP_PREFETCH", str(MAX_BATCH_SIZE)))
+
+# Profiling knobs
+# PROFILING_ENABLED turns on GET /admin/profile, guarded by the X-Admin-Token header; it stays off while
+# PROFILING_TOKEN is empty. Captures last at most PROFILING_MAX_SECONDS and download at most PROFILING_MAX_BYTES
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+if PROFILING_ENABLED and not PROFILING_TOKEN:
+    logger.warning("PROFILING_ENABLED needs PROFILING_TOKEN, /admin/profile stays disabled")
+    PROFILING_ENABLED = False
+PROFILING_MAX_SECONDS = float(os.environ.get("PROFILING_MAX_SECONDS", "30"))
+PROFILING_MAX_BYTES = int(os.environ.get("PROFILING_MAX_BYTES", str(50 * 1024 * 1024)))
+PROFILING_SAMPLE_INTERVAL_MS = float(os.environ.get("PROFILING_SAMPLE_INTERVAL_MS", "5"))
+
+# Streaming buffer pool knobs
+# Buffers are sized in STREAM_BUFFER_BLOCK token steps; STREAM_BUFFER_POOL_SIZE are kept per size
+STREAM_BUFFER_BLOCK = int(os.environ.get("STREAM_BUFFER_BLOCK", "128"))
+STREAM_BUFFER_POOL_SIZE = int(os.environ.get("STREAM_BUFFER_POOL_SIZE", "4"))
+# Streamed text is sent once STREAM_FLUSH_INTERVAL_MS has passed since the last chunk or
+# STREAM_FLUSH_BYTES are pending (0 and 1 send every decode step)
+STREAM_FLUSH_INTERVAL_MS = float(os.environ.get("STREAM_FLUSH_INTERVAL_MS", "20"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "256"))
+
+# CPU execution knobs
+# TORCH_NUM_THREADS and TORCH_INTEROP_THREADS size torch's intra-op and inter-op thread pools (0 keeps torch's
+# default, or the pinned cores for intra-op). CPU_AFFINITY pins to a core list ("0-7,16-23"), NUMA_NODES to the
+# cores of those nodes. `python app.py` runs SERVER_PROCESSES processes on one port, each pinned to its own slice
+# of those cores; they memory-map the same SNAPSHOT_DIR weights, so set it when running more than one
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "0"))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", "0"))
+CPU_AFFINITY = os.environ.get("CPU_AFFINITY", "")
+NUMA_NODES = [int(n) for n in os.environ.get("NUMA_NODES", "").split(",") if n.strip()]
+SERVER_PROCESSES = int(os.environ.get("SERVER_PROCESSES", "1"))
+# Set by the parent process for each server process it starts
+SERVER_PROCESS_INDEX = int(os.environ.get("SERVER_PROCESS_INDEX", "0"))
+# KV_CACHE_MAX_MB and the admission token budgets are per pod: each server process takes its share
+if SERVER_PROCESSES > 1:
+    KV_CACHE_MAX_MB /= SERVER_PROCESSES
+    STREAM_KV_CACHE_MAX_MB /= SERVER_PROCESSES
+    ADMISSION_TOKEN_BUDGET = max(1, ADMISSION_TOKEN_BUDGET // SERVER_PROCESSES)
+    ADMISSION_MAX_QUEUED_TOKENS = max(1, ADMISSION_MAX_QUEUED_TOKENS // SERVER_PROCESSES)
+
 # Determine the best available device for Mac optimization
 # MPS (Metal Performance Shaders) is Apple's GPU acceleration framework
 if torch.backends.mps.is_available():
@@ -52,15 +273,240 @@ else:
     device = torch.device("cpu")
     logger.info("Using CPU for inference")
 
-try:
-    # Load tokenizer with proper configuration
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-    
-    # Configure tokenizer for generation - required for proper text generation
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "left"
+# CPU Threads and Affinity
+# CPU forward passes scale with the cores torch's thread pools run on, and
+# threads that migrate between cores (or NUMA nodes) lose their caches and
+# read weights from remote memory. Each server process is pinned to its own
+# slice of the configured cores and sizes its intra-op pool to that slice, so
+# processes sharing a node never oversubscribe it. Memory first touched by
+# pinned threads is allocated on their node.
+def _parse_cpu_list(spec: str) -> List[int]:
+    """Core ids of a Linux cpu list such as "0-3,8,10-11"."""
+    cpus = []
+    for part in spec.split(","):
+        part = part.strip()
+        if part:
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _numa_node_cpus(node: int) -> List[int]:
+    with open(f"/sys/devices/system/node/node{node}/cpulist") as f:
+        return _parse_cpu_list(f.read())
+
+def _process_cpus(index: int, processes: int) -> Optional[List[int]]:
+    """Cores server process index (of processes) is pinned to, or None to leave its affinity alone."""
+    if NUMA_NODES:
+        # Processes are spread round-robin over the nodes and split the cores of their node
+        cpus = _numa_node_cpus(NUMA_NODES[index % len(NUMA_NODES)])
+        slot = index // len(NUMA_NODES)
+        slots = len(range(index % len(NUMA_NODES), processes, len(NUMA_NODES)))
+    elif CPU_AFFINITY:
+        cpus, slot, slots = _parse_cpu_list(CPU_AFFINITY), index, processes
+    else:
+        return None
+    per_process = max(1, len(cpus) // slots)
+    start = (slot * per_process) % len(cpus)
+    return cpus[start:start + per_process]
+
+def apply_cpu_profile(index: int = SERVER_PROCESS_INDEX, processes: int = SERVER_PROCESSES):
+    """Pin this process and size torch's thread pools; must run before the first forward pass."""
+    cpus = _process_cpus(index, processes)
+    if cpus is not None and not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU pinning is not supported on this platform, ignoring CPU_AFFINITY/NUMA_NODES")
+        cpus = None
+    if cpus is not None:
+        available = os.sched_getaffinity(0)
+        if not available.issuperset(cpus):
+            logger.warning(f"Cores {sorted(set(cpus) - available)} are not available to this process, skipping them")
+            cpus = [cpu for cpu in cpus if cpu in available] or None
+    if cpus is not None:
+        # Threads already running are pinned one by one; threads started later inherit the mask
+        for thread_id in os.listdir("/proc/self/task"):
+            os.sched_setaffinity(int(thread_id), cpus)
+
+    threads = TORCH_NUM_THREADS
+    if not threads and cpus is not None:
+        threads = len(cpus)
+    elif not threads and processes > 1:
+        # Unpinned processes split the cores they can all run on
+        available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        threads = max(1, available // processes)
+    if threads:
+        torch.set_num_threads(threads)
+    if TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Only possible before any inter-op work has started
+            logger.warning(f"Could not set {TORCH_INTEROP_THREADS} inter-op threads: {e}")
+    logger.info(f"CPU profile: process {index + 1}/{processes} | "
+                f"cores: {','.join(map(str, cpus)) if cpus is not None else 'unpinned'} | "
+                f"threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+# CPU Quantization
+def _cpu_supports_bf16() -> bool:
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
 
+def _conv1d_to_linear(model):
+    """
+    GPT-2 style models implement their projections with transformers' Conv1D
+    (a Linear with a transposed weight). Swap them for nn.Linear so dynamic
+    quantization, which only targets nn.Linear, covers them too.
+    """
+    from transformers.pytorch_utils import Conv1D
+
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1], dtype=child.weight.dtype)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+def _apply_quantization(model, mode: str):
+    """Apply the QUANTIZATION mode to a loaded model; returns the model and the mode actually used."""
+    if mode == "dynamic-int8":
+        if device.type != "cpu":
+            logger.warning("dynamic-int8 quantization only runs on CPU, serving unquantized")
+            return model, "none"
+        # Linear weights are stored as int8; activations are quantized on the fly. The LM head
+        # stays in full precision: its logits pick every token, and when it is tied to the input
+        # embeddings an int8 copy would untie it and add memory instead of saving it
+        model = _conv1d_to_linear(model)
+        lm_head = model.get_output_embeddings()
+        linear_names = {name for name, module in model.named_modules()
+                        if isinstance(module, torch.nn.Linear) and module is not lm_head}
+        model = torch.ao.quantization.quantize_dynamic(model, linear_names, dtype=torch.qint8)
+        return model, mode
+    if mode == "bf16":
+        if device.type == "cpu" and not _cpu_supports_bf16():
+            logger.warning("CPU has no native bf16 support, serving in float32")
+            return model, "none"
+        return model.to(torch.bfloat16), mode
+    if mode != "none":
+        logger.warning(f"Unknown QUANTIZATION '{mode}', serving unquantized")
+    return model, "none"
+
+def _model_memory_bytes(model) -> int:
+    """Bytes held by weights and buffers, counting packed int8 weights and shared tensors once."""
+    seen, total = set(), 0
+    for module in model.modules():
+        tensors = list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            tensors.extend(t for t in packed._weight_bias() if t is not None)
+        for tensor in tensors:
+            if tensor.data_ptr() not in seen:
+                seen.add(tensor.data_ptr())
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+# Model Snapshots
+# The first pod to load a model writes its converted weights (final dtype,
+# every parameter and buffer) to SNAPSHOT_DIR. Later starts memory-map that
+# file instead of downloading and converting the checkpoint again; pages are
+# shared through the page cache by every process on the node. Snapshots are
+# keyed by model revision, dtype, quantization and library versions, so an
+# upgrade writes a new one instead of loading an incompatible one. Offline,
+# the revision comes from the local Hub cache, or else the newest snapshot
+# written for the same setup is used.
+SNAPSHOT_WEIGHTS = "weights.pt"
+
+def _snapshot_revision(model_name: str) -> str:
+    try:
+        config = AutoConfig.from_pretrained(model_name)
+    except OSError:
+        # Offline or the Hub is unreachable: the copy in the local cache names its revision too
+        config = AutoConfig.from_pretrained(model_name, local_files_only=True)
+    # Hub models carry their commit; local checkpoints are told apart by their config
+    return getattr(config, "_commit_hash", None) or hashlib.sha256(config.to_json_string().encode()).hexdigest()
+
+def _snapshot_path(model_name: str, dtype: torch.dtype) -> str:
+    model_dir = os.path.join(SNAPSHOT_DIR, model_name.replace("/", "--"))
+    suffix = (f"-{str(dtype).replace('torch.', '')}-{QUANTIZATION}"
+              f"-torch{torch.__version__}-transformers{transformers.__version__}").replace("/", "_")
+    try:
+        revision = _snapshot_revision(model_name)
+    except OSError:
+        # No config anywhere but in the snapshots: start from the newest one written for this setup
+        existing = [
+            os.path.join(model_dir, name) for name in (os.listdir(model_dir) if os.path.isdir(model_dir) else [])
+            if name.endswith(suffix) and os.path.exists(os.path.join(model_dir, name, SNAPSHOT_WEIGHTS))
+        ]
+        if not existing:
+            raise
+        return max(existing, key=os.path.getmtime)
+    return os.path.join(model_dir, revision[:16] + suffix)
+
+def _discard_snapshot(path: str):
+    """Move an unusable snapshot aside and delete it, so the next load writes a fresh one."""
+    aside = f"{path}.discard-{uuid.uuid4().hex}"
+    try:
+        os.replace(path, aside)
+    except FileNotFoundError:
+        return  # another replica discarded it first
+    shutil.rmtree(aside, ignore_errors=True)
+
+def _write_snapshot(model, tokenizer, path: str):
+    """Write config, tokenizer and all tensors of a loaded model, atomically."""
+    # Unique per writer: replicas sharing the directory all run as PID 1
+    staging = f"{path}.tmp-{uuid.uuid4().hex}"
+    try:
+        os.makedirs(staging)
+        tensors = dict(model.named_parameters(remove_duplicate=False))
+        tensors.update(model.named_buffers(remove_duplicate=False))
+        torch.save({name: tensor.detach().cpu() for name, tensor in tensors.items()},
+                   os.path.join(staging, SNAPSHOT_WEIGHTS))
+        model.config.save_pretrained(staging)
+        tokenizer.save_pretrained(staging)
+        try:
+            os.replace(staging, path)
+        except OSError:
+            # Another replica published the same snapshot first
+            if not os.path.exists(os.path.join(path, SNAPSHOT_WEIGHTS)):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def _load_snapshot(path: str, dtype: torch.dtype):
+    """Build the model skeleton on the meta device and attach memory-mapped tensors."""
+    config = AutoConfig.from_pretrained(path)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    tensors = torch.load(os.path.join(path, SNAPSHOT_WEIGHTS), mmap=True, weights_only=True)
+    for name, tensor in tensors.items():
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[attr] = tensor
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f"Snapshot is missing tensors: {missing[:5]}")
+    return model
+
+# Tokenizers of the served models, keyed by their serialized vocabulary and
+# settings; models whose tokenizers are identical share one instance
+_tokenizers: Dict[str, object] = {}
+_tokenizers_lock = threading.Lock()
+
+def _shared_tokenizer(tokenizer):
+    """Return the already loaded tokenizer identical to this one, or register this one."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is None:
+        return tokenizer
+    key = hashlib.sha256(f"{type(tokenizer).__name__}|{backend.to_str()}|"
+                         f"{tokenizer.padding_side}|{tokenizer.pad_token}".encode()).hexdigest()
+    with _tokenizers_lock:
+        return _tokenizers.setdefault(key, tokenizer)
+
+def _load_kwargs() -> dict:
     # Model loading configuration optimized for Mac M-series
     # Different settings for different device types
     load_kwargs = {
@@ -69,28 +515,104 @@ try:
     
     # Choose appropriate precision based on device
     # Lower precision (fp16) uses less memory but may reduce accuracy slightly
-    if device.type != "cpu":
+    if device.type != "cpu" and QUANTIZATION == "bf16":
+        load_kwargs["torch_dtype"] = torch.bfloat16  # Loaded straight into bf16, not cast from an fp16 copy
+    elif device.type != "cpu":
         load_kwargs["torch_dtype"] = torch.float16  # Half precision for GPU/MPS
+    elif QUANTIZATION == "bf16" and _cpu_supports_bf16():
+        load_kwargs["torch_dtype"] = torch.bfloat16  # Half the memory on CPUs with native bf16
     else:
         load_kwargs["torch_dtype"] = torch.float32  # Full precision for CPU
+    return load_kwargs
+
+def _load_draft_model(load_kwargs: dict, tokenizer, model):
+    """Load DRAFT_MODEL_NAME the same way as the main model; it must share its vocabulary."""
+    draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_NAME)
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise ValueError(f"{DRAFT_MODEL_NAME} does not share the tokenizer of {MODEL_NAME}")
+    draft = AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_NAME, **load_kwargs)
+    if draft.config.vocab_size != model.config.vocab_size:
+        raise ValueError(f"{DRAFT_MODEL_NAME} has vocab size {draft.config.vocab_size}, "
+                         f"{MODEL_NAME} has {model.config.vocab_size}")
+    draft = draft.to(device)
+    draft.eval()
+    draft, _ = _apply_quantization(draft, QUANTIZATION)
+    return draft
+
+def load_model(model_name: str = MODEL_NAME) -> "ServedModel":
+    """
+    Load tokenizer and model, from a snapshot when one exists. Blocking - runs
+    off the event loop at startup (and for models loaded on demand) so probes
+    are answered while weights load. The draft model only serves MODEL_NAME.
+    """
+    global QUANTIZATION
+
+    load_start = time.time()
+    load_kwargs = _load_kwargs()
+    snapshot_path = None
+    if SNAPSHOT_DIR:
+        try:
+            snapshot_path = _snapshot_path(model_name, load_kwargs["torch_dtype"])
+        except Exception as e:
+            logger.warning(f"Could not resolve the snapshot of {model_name}, loading without one: {e}")
+    model = None
+    if snapshot_path and os.path.exists(os.path.join(snapshot_path, SNAPSHOT_WEIGHTS)):
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(snapshot_path)
+            model = _load_snapshot(snapshot_path, load_kwargs["torch_dtype"])
+            logger.info(f"Loaded snapshot {snapshot_path} in {time.time() - load_start:.2f}s")
+        except Exception as e:
+            logger.warning(f"Snapshot {snapshot_path} unusable, loading {model_name} instead: {e}")
+            model = None
+            _discard_snapshot(snapshot_path)
+
+    if model is None:
+        # Load tokenizer with proper configuration
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        
+        # Load the model without device_map="auto" which can cause issues on Mac
+        logger.info(f"Loading model {model_name} with settings: {load_kwargs}")
+        model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+        
+        if snapshot_path:
+            try:
+                _write_snapshot(model, tokenizer, snapshot_path)
+                logger.info(f"Wrote model snapshot to {snapshot_path}")
+            except Exception as e:
+                logger.warning(f"Could not write model snapshot to {snapshot_path}: {e}")
     
-    # Load the model without device_map="auto" which can cause issues on Mac
-    logger.info(f"Loading model with settings: {load_kwargs}")
-    model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, **load_kwargs)
+    # Configure tokenizer for generation - required for proper text generation
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    tokenizer = _shared_tokenizer(tokenizer)
     
     # Explicitly move model to the detected device
     model = model.to(device)
     
     # Set model to evaluation mode for inference
     model.eval()
-    logger.info(f"Model {MODEL_NAME} loaded successfully on {device}")
-    model_loaded = True
+    
+    # Quantize after loading so the same checkpoint serves every mode
+    model, quantization = _apply_quantization(model, QUANTIZATION)
+    if model_name == MODEL_NAME:
+        QUANTIZATION = quantization
+    model_memory_bytes = _model_memory_bytes(model)
+    MODEL_MEMORY.labels(model=model_name, quantization=quantization).set(model_memory_bytes)
+    logger.info(f"Model {model_name} loaded successfully on {device} | "
+                f"quantization: {quantization} | memory: {model_memory_bytes / 1024 ** 2:.1f} MB")
 
-except Exception as e:
-    logger.error(f"Error loading model: {e}")
-    import traceback
-    logger.error(traceback.format_exc())
-    raise HTTPException(status_code=500, detail=f"Model loading failed: {e}")
+    draft_model = None
+    if DRAFT_MODEL_NAME and model_name == MODEL_NAME:
+        # Speculation is an optimization - a draft that fails to load never blocks serving
+        try:
+            draft_model = _load_draft_model(load_kwargs, tokenizer, model)
+            logger.info(f"Draft model {DRAFT_MODEL_NAME} loaded, speculating {SPECULATIVE_TOKENS} tokens per step")
+        except Exception as e:
+            logger.warning(f"Draft model {DRAFT_MODEL_NAME} unusable, decoding without speculation: {e}")
+    MODEL_LOADS.labels(model=model_name).inc()
+    MODEL_LOAD_SECONDS.labels(model=model_name).observe(time.time() - load_start)
+    return ServedModel(model_name, tokenizer, model, quantization, draft_model=draft_model)
 
 # Pydantic models for request/response validation
 class TokenCount(BaseModel):
@@ -107,12 +629,35 @@ class InferenceRequest(BaseModel):
     repetition_penalty: float = Field(1.2, ge=0.5, le=2.0, description="Penalty for repeating tokens")
     num_return_sequences: int = Field(1, ge=1, le=5, description="Number of sequences to generate")
     stream: bool = Field(False, description="Whether to stream the response token by token")
+    do_sample: bool = Field(True, description="Sample tokens; false decodes greedily")
+    seed: Optional[int] = Field(None, ge=0, description="Fixed sampling seed for reproducible output")
+    cache: bool = Field(False, description="Allow an identical earlier response to be served from cache")
+    user_id: Optional[str] = Field(None, description="Caller the request is queued under for fair sharing")
+    model: Optional[str] = Field(None, description="Model to run, one of SERVED_MODELS (MODEL_NAME when unset)")
 
 class InferenceResponse(BaseModel):
     output_text: str
     token_usage: TokenCount
     model: str
     processing_time: float
+    cached: bool = False
+    # All generated texts when num_return_sequences > 1 (output_text is the first)
+    output_texts: Optional[List[str]] = None
+
+class BatchInferenceRequest(BaseModel):
+    requests: List[InferenceRequest] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS,
+                                             description="Prompts with their own sampling params")
+
+class BatchInferenceItem(BaseModel):
+    index: int
+    result: Optional[InferenceResponse] = None
+    error: Optional[str] = None
+
+class BatchInferenceResponse(BaseModel):
+    results: List[BatchInferenceItem]
+    token_usage: TokenCount
+    model: str
+    processing_time: float
 
 class StreamingChunk(BaseModel):
     token: str
@@ -121,9 +666,224 @@ class StreamingChunk(BaseModel):
     model: Optional[str] = None
     processing_time: Optional[float] = None
 
+# Shared Redis client, created on first use
+_redis_client = None
+
+def get_redis():
+    """Return the asyncio Redis client for REDIS_URL, or None when Redis is not configured."""
+    global _redis_client
+    if _redis_client is None and REDIS_URL:
+        import redis.asyncio as aioredis
+        _redis_client = aioredis.from_url(REDIS_URL)
+    return _redis_client
+
 # SSE Notification System - NEW
-# Store active SSE connections by request_id
-active_connections: Dict[str, asyncio.Queue] = {}
+# SSE clients subscribe on whichever replica they connected to, but /notify can
+# land on any replica. Notifications for a client that is not connected here
+# are buffered under their request_id (with a TTL, so they also wait for
+# clients that have not connected yet) and a wake-up is broadcast to every
+# replica; the replica holding the subscriber claims the buffer and delivers.
+class MemoryNotificationBackend:
+    """In-process stand-in for Redis: a single replica, or several hubs in one process for tests."""
+
+    def __init__(self):
+        self._listeners: List[asyncio.Queue] = []
+        # request_id -> (expires_at, messages), roughly in expiry order
+        self._buffers: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def buffer(self, entries: List[tuple], ttl: float):
+        """Append (request_id, message) entries to their buffers."""
+        now = time.time()
+        while self._buffers and next(iter(self._buffers.values()))[0] <= now:
+            self._buffers.popitem(last=False)
+        for request_id, message in entries:
+            _, messages = self._buffers.pop(request_id, (None, []))
+            messages.append(message)
+            self._buffers[request_id] = (now + ttl, messages)
+
+    async def take_buffered(self, request_id: str) -> List[str]:
+        expires_at, messages = self._buffers.pop(request_id, (0, []))
+        return messages if expires_at > time.time() else []
+
+    async def publish(self, request_ids: List[str]):
+        for listener in self._listeners:
+            for request_id in request_ids:
+                listener.put_nowait(request_id)
+
+    async def listen(self) -> AsyncGenerator[str, None]:
+        listener = asyncio.Queue()
+        self._listeners.append(listener)
+        try:
+            while True:
+                yield await listener.get()
+        finally:
+            self._listeners.remove(listener)
+
+class RedisNotificationBackend:
+    """Buffers in a Redis list per request_id and broadcasts wake-ups over pub/sub."""
+
+    CHANNEL = "ml:notifications"
+
+    def _key(self, request_id: str) -> str:
+        return f"ml:notify:{request_id}"
+
+    async def buffer(self, entries: List[tuple], ttl: float):
+        """Append (request_id, message) entries to their buffers in one round trip."""
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for request_id, message in entries:
+                pipe.rpush(self._key(request_id), message).expire(self._key(request_id), max(1, int(ttl)))
+            await pipe.execute()
+
+    async def take_buffered(self, request_id: str) -> List[str]:
+        # Read and delete atomically, so exactly one replica delivers each message
+        async with get_redis().pipeline(transaction=True) as pipe:
+            messages, _ = await pipe.lrange(self._key(request_id), 0, -1).delete(self._key(request_id)).execute()
+        return messages
+
+    async def publish(self, request_ids: List[str]):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for request_id in request_ids:
+                pipe.publish(self.CHANNEL, request_id)
+            await pipe.execute()
+
+    async def listen(self) -> AsyncGenerator[str, None]:
+        pubsub = get_redis().pubsub()
+        await pubsub.subscribe(self.CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    data = message["data"]
+                    yield data.decode() if isinstance(data, bytes) else data
+        finally:
+            await pubsub.close()
+
+def _sse_item(event: dict, published_at: Optional[float]) -> tuple:
+    """Queue item for an SSE connection: (encoded frame, publish time, whether it ends the stream)."""
+    return f"data: {json.dumps(event)}\n\n", published_at, event.get("type") in ("completed", "failed")
+
+class NotificationHub:
+    """
+    Local SSE subscriptions plus cross-replica routing through a notification
+    backend. Subscriber queues receive ready-to-send frames; one ticker sends
+    keepalive pings to every connection instead of a timer per connection.
+    """
+
+    def __init__(self, backend, buffer_ttl: float = NOTIFY_BUFFER_TTL_SECONDS,
+                 keepalive_interval: float = SSE_KEEPALIVE_SECONDS):
+        self.backend = backend
+        self.buffer_ttl = buffer_ttl
+        self.keepalive_interval = keepalive_interval
+        # Only touched from the event loop, so no locking is needed
+        self._subscribers: Dict[str, asyncio.Queue] = {}
+        # request_id -> live events held back while its buffer is replayed, so the backlog is sent first
+        self._replays: Dict[str, list] = {}
+        # Replays that must take the buffer again, woken while they were running
+        self._replay_again: set = set()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def connection_count(self) -> int:
+        return len(self._subscribers)
+
+    def start(self):
+        """Start listening for wake-ups from other replicas and the keepalive ticker (idempotent)."""
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._listen()), loop.create_task(self._keepalive())]
+            logger.info(f"Notification hub started ({type(self.backend).__name__}, "
+                        f"keepalive every {self.keepalive_interval:.0f}s)")
+
+    async def subscribe(self, request_id: str) -> asyncio.Queue:
+        """Register an SSE client; notifications buffered before it connected are queued first."""
+        queue = asyncio.Queue()
+        self._subscribers[request_id] = queue
+        SSE_CONNECTIONS.set(len(self._subscribers))
+        await self._deliver_buffered(request_id)
+        return queue
+
+    def unsubscribe(self, request_id: str, queue: asyncio.Queue):
+        # A reconnect may already have replaced this subscription
+        if self._subscribers.get(request_id) is queue:
+            del self._subscribers[request_id]
+            SSE_CONNECTIONS.set(len(self._subscribers))
+
+    async def publish(self, event: dict) -> str:
+        """Deliver an event; returns "sent" if the client is connected here, else "queued"."""
+        return (await self.publish_many([event]))[0]
+
+    async def publish_many(self, events: List[dict]) -> List[str]:
+        """Deliver several events, with one backend round trip for all that are not local."""
+        published_at = time.time()
+        statuses, queued = [], []
+        for event in events:
+            queue = self._subscribers.get(event["request_id"])
+            if queue is not None:
+                held = self._replays.get(event["request_id"])
+                if held is not None:
+                    held.append(_sse_item(event, published_at))
+                else:
+                    queue.put_nowait(_sse_item(event, published_at))
+                statuses.append("sent")
+            else:
+                queued.append((event["request_id"], json.dumps({"event": event, "published_at": published_at})))
+                statuses.append("queued")
+        if queued:
+            await self.backend.buffer(queued, self.buffer_ttl)
+            await self.backend.publish([request_id for request_id, _ in queued])
+        return statuses
+
+    async def _deliver_buffered(self, request_id: str):
+        """Replay a subscriber's buffered events together with the live ones published meanwhile, oldest first."""
+        if request_id in self._replays:
+            self._replay_again.add(request_id)
+            return
+        held = self._replays[request_id] = []
+        try:
+            while True:
+                self._replay_again.discard(request_id)
+                for message in await self.backend.take_buffered(request_id):
+                    buffered = json.loads(message)
+                    held.append(_sse_item(buffered["event"], buffered["published_at"]))
+                if request_id not in self._replay_again:
+                    break
+        finally:
+            del self._replays[request_id]
+            self._replay_again.discard(request_id)
+            queue = self._subscribers.get(request_id)
+            if queue is not None:
+                for item in sorted(held, key=lambda item: item[1]):
+                    queue.put_nowait(item)
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            # Encoded once per tick and shared by every connection
+            item = (f"data: {json.dumps({'type': 'ping', 'timestamp': time.time()})}\n\n", None, False)
+            for queue in self._subscribers.values():
+                queue.put_nowait(item)
+
+    async def _listen(self):
+        while True:
+            try:
+                async for request_id in self.backend.listen():
+                    if request_id in self._subscribers:
+                        await self._deliver_buffered(request_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Notification listener failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+def _create_notification_backend():
+    if NOTIFY_BACKEND == "redis":
+        if REDIS_URL:
+            return RedisNotificationBackend()
+        logger.warning("NOTIFY_BACKEND=redis needs REDIS_URL, routing notifications in memory")
+    elif NOTIFY_BACKEND != "memory":
+        logger.warning(f"Unknown NOTIFY_BACKEND '{NOTIFY_BACKEND}', routing notifications in memory")
+    return MemoryNotificationBackend()
+
+notification_hub = NotificationHub(_create_notification_backend())
 
 class NotificationPayload(BaseModel):
     """HTTP notification payload from Results Collector"""
@@ -138,16 +898,41 @@ class NotificationPayload(BaseModel):
 @app.get("/health")
 async def health_check():
     # Fast health check that doesn't depend on model processing
-    # This always responds quickly for Kubernetes probes
+    # This always responds quickly for Kubernetes probes (liveness)
+    if model_load_error:
+        raise HTTPException(status_code=503, detail=f"Model loading failed: {model_load_error}")
     return {
         "status": "healthy", 
         "model": MODEL_NAME, 
         "device": str(device),
+        "quantization": QUANTIZATION,
+        "server_processes": SERVER_PROCESSES,
+        "torch_threads": torch.get_num_threads(),
         "model_loaded": model_loaded,
-        "processing_request": processing_request,
-        "active_sse_connections": len(active_connections)  # NEW: Show SSE connection count
+        "model_ready": model_ready,
+        "processing_request": admission.active_requests + stream_admission.active_requests > 0,
+        "active_sse_connections": notification_hub.connection_count,  # NEW: Show SSE connection count
+        "pending_requests": inference_executor.pending,
+        "queued_requests": model_registry.queue_depth,
+        "batch_size": model_registry.batch_size,
+        "loaded_models": model_registry.loaded,
+        "loaded_model_memory_bytes": model_registry.memory_bytes,
+        "admission_queue_depth": admission.queue_depth,
+        "admission_queued_tokens": admission.queued_tokens,
+        "admission_active_tokens": admission.active_tokens,
+        "amqp_in_flight": amqp_consumer.in_flight if amqp_consumer else 0
     }
 
+@app.get("/ready")
+async def readiness_check():
+    # Readiness only flips once the model is loaded and the engine is serving
+    if not model_ready:
+        raise HTTPException(status_code=503, detail="Model is not ready")
+    # A pod serves from every process once it is ready, so it is only ready when all of them are
+    if server_processes_ready is not None and not all(server_processes_ready):
+        raise HTTPException(status_code=503, detail="Server processes are not ready")
+    return {"status": "ready", "model": MODEL_NAME}
+
 # SSE Notification Endpoints - NEW
 @app.get("/events/{request_id}")
 async def sse_stream(request_id: str, request: Request):
@@ -157,46 +942,40 @@ async def sse_stream(request_id: str, request: Request):
     """
     logger.info(f"SSE connection opened for request_id: {request_id}")
     
-    # Create a queue for this connection
-    queue = asyncio.Queue()
-    active_connections[request_id] = queue
-    
     async def event_generator():
+        # Subscribe this connection; anything buffered for it is already queued.
+        # Done here so the finally below always unsubscribes it
+        queue = await notification_hub.subscribe(request_id)
+        connected_at = time.time()
         try:
             # Send initial connection confirmation
             yield f"data: {json.dumps({'type': 'connected', 'request_id': request_id, 'timestamp': time.time()})}\n\n"
             
+            # Only wakes for events and the hub's keepalive pings. A client
+            # disconnect (ASGI http.disconnect) cancels this generator.
             while True:
-                # Check if client disconnected
-                if await request.is_disconnected():
-                    logger.info(f"Client disconnected: {request_id}")
-                    break
+                frame, published_at, closes = await queue.get()
                 
-                try:
-                    # Wait for notification with timeout
-                    event = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    
-                    # Send the event to client
-                    yield f"data: {json.dumps(event)}\n\n"
-                    
-                    # If it's a completion event, close the connection
-                    if event.get("type") in ["completed", "failed"]:
-                        logger.info(f"Completion event sent for {request_id}, closing connection")
-                        break
-                        
-                except asyncio.TimeoutError:
-                    # Send keepalive ping
-                    yield f"data: {json.dumps({'type': 'ping', 'timestamp': time.time()})}\n\n"
+                # Send the event to client
+                yield frame
+                if published_at is not None:
+                    # Events buffered before the client connected count from the connect
+                    SSE_FANOUT_SECONDS.observe(max(0.0, time.time() - max(published_at, connected_at)))
+                
+                # If it's a completion event, close the connection
+                if closes:
+                    logger.info(f"Completion event sent for {request_id}, closing connection")
+                    break
                     
         except asyncio.CancelledError:
             logger.info(f"SSE connection cancelled for {request_id}")
+            raise
         except Exception as e:
             logger.error(f"Error in SSE stream for {request_id}: {e}")
         finally:
             # Clean up connection
-            if request_id in active_connections:
-                del active_connections[request_id]
-                logger.info(f"Cleaned up SSE connection for {request_id}")
+            notification_hub.unsubscribe(request_id, queue)
+            logger.info(f"Cleaned up SSE connection for {request_id}")
     
     return StreamingResponse(
         event_generator(),
@@ -209,6 +988,21 @@ async def sse_stream(request_id: str, request: Request):
         }
     )
 
+def _notification_event(notification: NotificationPayload) -> dict:
+    """SSE event for a notification, with optional fields only if present."""
+    event_data = {
+        "type": notification.type,
+        "request_id": notification.request_id,
+        "timestamp": notification.timestamp or time.time()
+    }
+    if notification.result:
+        event_data["result"] = notification.result
+    if notification.error:
+        event_data["error"] = notification.error
+    if notification.token_usage:
+        event_data["token_usage"] = notification.token_usage
+    return event_data
+
 @app.post("/notify")
 async def receive_notification(notification: NotificationPayload):
     """
@@ -218,246 +1012,3016 @@ async def receive_notification(notification: NotificationPayload):
     request_id = notification.request_id
     logger.info(f"Received notification for {request_id}: {notification.type}")
     
-    # Check if there's an active connection for this request
-    if request_id not in active_connections:
-        logger.warning(f"No active connection for request_id: {request_id}")
-        return {"status": "no_connection", "request_id": request_id}
-    
     try:
         # Prepare event data
-        event_data = {
-            "type": notification.type,
-            "request_id": request_id,
-            "timestamp": notification.timestamp or time.time()
-        }
+        event_data = _notification_event(notification)
         
-        # Add optional fields if present
-        if notification.result:
-            event_data["result"] = notification.result
-        if notification.error:
-            event_data["error"] = notification.error
-        if notification.token_usage:
-            event_data["token_usage"] = notification.token_usage
-        
-        # Send to SSE client
-        queue = active_connections[request_id]
-        await queue.put(event_data)
+        # Send to the SSE client here, or route it to the replica it is connected to
+        status = await notification_hub.publish(event_data)
         logger.info(f"Forwarding event to SSE: {event_data}")
         
-        logger.info(f"Notification sent to SSE client for {request_id}")
-        return {"status": "sent", "request_id": request_id}
+        logger.info(f"Notification {status} for SSE client of {request_id}")
+        return {"status": status, "request_id": request_id}
         
     except Exception as e:
         logger.error(f"Error sending notification for {request_id}: {e}")
         return {"status": "error", "request_id": request_id, "error": str(e)}
 
-# Separate function to do the actual inference
-async def run_inference(request: InferenceRequest):
-    start_time = time.time()
-    
-    # Tokenize input with proper attention mask
-    inputs = tokenizer(
-        request.prompt,
-        return_tensors="pt",
-        return_attention_mask=True,
-        padding=True
-    )
-    
-    # Move inputs to the device where the model is
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+@app.post("/notify/batch")
+async def receive_notification_batch(request: Request):
+    """
+    Batched /notify for the Results Collector. The body is a JSON array or
+    NDJSON of notification payloads; each item is validated and dispatched on
+    its own, and the response carries a status per item in request order.
+    Only summary counts are logged.
+    """
+    body = await request.body()
+    if body.lstrip().startswith(b"["):
+        try:
+            raw_items = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON array: {e}")
+    else:
+        raw_items = [line for line in body.splitlines() if line.strip()]
+    if len(raw_items) > NOTIFY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {NOTIFY_BATCH_MAX_ITEMS} notifications per batch")
 
-    prompt_tokens = inputs["input_ids"].shape[-1]
-    
-    # Generation parameters - optimized for speed
-    gen_kwargs = {
-        "input_ids": inputs["input_ids"],
-        "attention_mask": inputs["attention_mask"],
-        "max_length": min(request.max_length, 100),  # Reduced for speed
-        "temperature": request.temperature,
-        "top_p": request.top_p,
-        "top_k": request.top_k,
-        "repetition_penalty": request.repetition_penalty,
-        "num_return_sequences": 1,  # Stick to 1 sequence
-        "do_sample": True,
-        "pad_token_id": tokenizer.eos_token_id,
-        "eos_token_id": tokenizer.eos_token_id
-    }
+    results: List[dict] = []
+    events, positions = [], []
+    for index, raw in enumerate(raw_items):
+        try:
+            if isinstance(raw, bytes):
+                notification = NotificationPayload.model_validate_json(raw)
+            else:
+                notification = NotificationPayload.model_validate(raw)
+        except ValueError as e:
+            results.append({"index": index, "status": "invalid", "error": str(e)})
+            continue
+        results.append({"index": index, "status": None, "request_id": notification.request_id})
+        events.append(_notification_event(notification))
+        positions.append(index)
 
-    # Generate text with timing
-    with PROCESSING_TIME.labels(model=MODEL_NAME).time():
-        # inference_mode is more memory efficient than no_grad for PyTorch inference
-        with torch.inference_mode():
-            outputs = model.generate(**gen_kwargs)
+    try:
+        statuses = await notification_hub.publish_many(events) if events else []
+    except Exception as e:
+        logger.error(f"Error dispatching notification batch: {e}")
+        statuses = ["error"] * len(events)
+        for position in positions:
+            results[position]["error"] = str(e)
+    for position, status in zip(positions, statuses):
+        results[position]["status"] = status
 
-    # Decode generated text, skipping the input tokens
-    output_text = tokenizer.decode(
-        outputs[0][inputs["input_ids"].shape[-1]:], 
-        skip_special_tokens=True
-    )
+    counts: Dict[str, int] = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    logger.info(f"Notification batch of {len(results)}: " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items())))
+    return {"results": results, "counts": counts}
 
-    # Calculate token usage
-    completion_tokens = len(outputs[0]) - prompt_tokens
-    total_tokens = prompt_tokens + completion_tokens
+# Inference Executor
+# All model work (batched engine steps and streaming decode steps) runs on a
+# dedicated thread pool so /health, /events and /notify never wait on a forward
+# pass. Admission is bounded: once max_pending requests hold a slot, new ones
+# are rejected with 503 instead of piling up behind the model.
+class ExecutorSaturated(Exception):
+    """Raised when the inference executor has no free admission slot."""
 
-    # Update metrics
-    REQUESTS.labels(model=MODEL_NAME).inc()
-    TOKENS_PROCESSED.labels(type="prompt", model=MODEL_NAME).inc(prompt_tokens)
-    TOKENS_PROCESSED.labels(type="completion", model=MODEL_NAME).inc(completion_tokens)
+class _ExecutorSlot:
+    """Admission slot(s) held by one request; released exactly once."""
 
-    # Calculate processing time
-    processing_time = time.time() - start_time
-    logger.info(f"Inference completed in {processing_time:.2f}s | Tokens: {total_tokens}")
+    def __init__(self, executor: "InferenceExecutor", count: int = 1):
+        self._executor = executor
+        self._count = count
+        self._released = False
 
-    return InferenceResponse(
-        output_text=output_text,
-        token_usage=TokenCount(
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=total_tokens
-        ),
-        model=MODEL_NAME,
-        processing_time=processing_time
-    )
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._executor._pending -= self._count
 
-async def _generate_next_token(model, tokenizer, generated, attention_mask, past_key_values, request):
-    """Helper function to generate the next token."""
-    # Prepare model inputs with proper attention mask and past key values
-    model_inputs = {
-        "input_ids": generated[:, -1:] if past_key_values is not None else generated,
-        "attention_mask": attention_mask,
-    }
-    
-    if past_key_values is not None:
-        model_inputs["past_key_values"] = past_key_values
-    
-    # Generate next token logits
-    outputs = model(**model_inputs, use_cache=True)
-    past_key_values = outputs.past_key_values
-    
-    # Apply temperature scaling and top-k filtering
-    next_token_logits = outputs.logits[:, -1, :] / request.temperature
-    
-    if request.top_k > 0:
-        indices_to_remove = next_token_logits < torch.topk(next_token_logits, request.top_k)[0][..., -1, None]
-        next_token_logits[indices_to_remove] = -float("Inf")
-    
-    # Sample next token from probability distribution
-    probs = torch.nn.functional.softmax(next_token_logits, dim=-1)
-    next_token = torch.multinomial(probs, num_samples=1).squeeze(1)
-    
-    return next_token, past_key_values
+    def __del__(self):
+        # Every path releases explicitly; releasing here could run on any thread
+        if not self._released:
+            logger.warning(f"Executor slot for {self._count} request(s) was never released")
 
-async def stream_inference(request: InferenceRequest) -> AsyncGenerator[str, None]:
-    start_time = time.time()
-    
-    # Tokenize input with proper attention mask
-    inputs = tokenizer(
-        request.prompt,
-        return_tensors="pt",
-        return_attention_mask=True,
-        padding=True
-    )
-    
-    # Move inputs to the device where the model is
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    prompt_tokens = inputs["input_ids"].shape[-1]
-    
-    # Initialize generation state
-    generated = inputs["input_ids"].clone()
-    past_key_values = None
-    attention_mask = inputs["attention_mask"]
-    completion_tokens = 0
-    max_length = min(request.max_length + prompt_tokens, prompt_tokens + 100)
-    
-    # Generate tokens one by one to enable streaming
-    with PROCESSING_TIME.labels(model=MODEL_NAME).time():
-        with torch.inference_mode():
-            for _ in range(max_length - prompt_tokens):
-                # Generate next token using helper function
-                next_token, past_key_values = await _generate_next_token(
-                    model, tokenizer, generated, attention_mask, past_key_values, request
-                )
-                
-                # Update generation state
-                generated = torch.cat([generated, next_token.unsqueeze(-1)], dim=-1)
-                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=-1)
-                
-                # Decode and process the generated token
-                token_text = tokenizer.decode([next_token[0].item()], skip_special_tokens=True)
-                completion_tokens += 1
-                
-                # Skip empty tokens but don't stop generation
-                if token_text.strip():
-                    # Check if generation should stop
-                    is_finished = next_token.item() == tokenizer.eos_token_id or completion_tokens >= (max_length - prompt_tokens)
-                    chunk = {"token": token_text, "is_finished": is_finished}
-                    
-                    # Add final metadata when generation is complete
-                    if is_finished:
-                        total_tokens = prompt_tokens + completion_tokens
-                        processing_time = time.time() - start_time
-                        
-                        # Update metrics
-                        REQUESTS.labels(model=MODEL_NAME).inc()
-                        TOKENS_PROCESSED.labels(type="prompt", model=MODEL_NAME).inc(prompt_tokens)
-                        TOKENS_PROCESSED.labels(type="completion", model=MODEL_NAME).inc(completion_tokens)
-                        
-                        # Add final metadata to the chunk
-                        chunk.update({
-                            "token_count": {
-                                "prompt_tokens": prompt_tokens,
-                                "completion_tokens": completion_tokens,
-                                "total_tokens": total_tokens
-                            },
-                            "model": MODEL_NAME,
-                            "processing_time": processing_time
-                        })
-                        
-                        logger.info(f"Streaming inference completed in {processing_time:.2f}s | Tokens: {total_tokens}")
-                    
-                    # Yield the chunk and break if generation is complete
-                    yield json.dumps(chunk) + "\n"
-                    
-                    if is_finished:
-                        break
+class InferenceExecutor:
+    def __init__(self, workers: int = INFERENCE_WORKERS, max_pending: int = INFERENCE_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._pending = 0
+        # Set only while /admin/profile is capturing
+        self._capture: Optional["TorchProfileCapture"] = None
 
-@app.post("/inference")
-async def inference(request: InferenceRequest):
-    global processing_request
-    start_time = time.time()
-    logger.info(f"Received inference request: {request.prompt[:50]}...")
-    processing_request = True
-    
-    try:
-        # Check if streaming is requested
-        if request.stream:
-            logger.info("Streaming response requested")
-            # Return a streaming response
-            return StreamingResponse(
-                stream_inference(request),
-                media_type="application/x-ndjson"
-            )
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def reserve(self, count: int = 1) -> _ExecutorSlot:
+        """Take count admission slots or raise ExecutorSaturated when the queue is full."""
+        if self._pending + count > self.max_pending:
+            raise ExecutorSaturated(f"{self._pending} requests already pending")
+        self._pending += count
+        return _ExecutorSlot(self, count)
+
+    async def run(self, fn, *args):
+        """Run a blocking model call on the inference threads."""
+        if self._capture is not None:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, self._run_captured, self._capture, fn, args)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    @staticmethod
+    def _run_captured(capture: "TorchProfileCapture", fn, args):
+        capture.attach()
+        return fn(*args)
+
+    def start_capture(self, capture: "TorchProfileCapture"):
+        self._capture = capture
+
+    async def stop_capture(self):
+        """Stop recording; the profiler is stopped on the thread that started it."""
+        capture, self._capture = self._capture, None
+        if capture is None:
+            return
+        # One job per worker, held at a barrier so each lands on a different thread
+        barrier = threading.Barrier(self.workers, timeout=60)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._pool, self._detach_capture, capture, barrier) for _ in range(self.workers)
+        ))
+
+    @staticmethod
+    def _detach_capture(capture: "TorchProfileCapture", barrier: threading.Barrier):
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        capture.detach()
+
+inference_executor = InferenceExecutor()
+logger.info(f"Inference executor: {inference_executor.workers} worker thread(s), "
+            f"queue size {inference_executor.max_pending}")
+
+# Admission Control
+# Requests are admitted against a budget of estimated tokens in flight. Once
+# the budget is spent, requests wait in per-user queues and are admitted user
+# by user - the waiting user with the fewest tokens in flight goes first - so a
+# client with a burst of long prompts cannot starve everyone else. When the
+# backlog is already too deep, or a request has waited too long, it is shed
+# with 429 instead of timing out at the gateway.
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of queued."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+class _AdmissionTicket:
+    """Token budget held by one admitted request; released exactly once."""
+
+    def __init__(self, controller: "AdmissionController", user_id: str, cost: int):
+        self._controller = controller
+        self.user_id = user_id
+        self.cost = cost
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+    def __del__(self):
+        # Every path releases explicitly; releasing here could run on any thread
+        if not self._released:
+            logger.warning(f"Admission ticket of {self.cost} tokens for {self.user_id} was never released")
+
+class _Waiter:
+    __slots__ = ("user_id", "cost", "future")
+
+    def __init__(self, user_id: str, cost: int, future: asyncio.Future):
+        self.user_id = user_id
+        self.cost = cost
+        self.future = future
+
+def _request_cost(request: InferenceRequest, prompt_tokens: int, served: "ServedModel") -> int:
+    """
+    Estimated tokens a request holds while it runs. With a shared KV budget
+    they are counted at MODEL_NAME's KV size, so a model with twice the cache
+    per token costs twice as much.
+    """
+    tokens = prompt_tokens + request.max_length * request.num_return_sequences
+    if kv_budget is not None and kv_budget.token_bytes and served.kv_pool is not None:
+        tokens = -(-tokens * served.kv_pool.token_bytes // kv_budget.token_bytes)
+    return tokens
+
+class AdmissionController:
+    def __init__(self, name: str = "default", token_budget: int = ADMISSION_TOKEN_BUDGET,
+                 max_queued_tokens: int = ADMISSION_MAX_QUEUED_TOKENS, max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.name = name
+        self.token_budget = max(1, token_budget)
+        self.max_queued_tokens = max(0, max_queued_tokens)
+        self.max_wait = max_wait
+        self.active_tokens = 0
+        self.active_requests = 0
+        self.queued_tokens = 0
+        self.queue_depth = 0
+        self._active_by_user: Dict[str, int] = {}
+        self._queued_by_user: Dict[str, int] = {}
+        # user_id -> waiters in arrival order; users with nothing waiting are removed
+        self._waiting: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+
+    def set_token_budget(self, token_budget: int):
+        """Resize the budget, e.g. to the KV cache capacity once the model is loaded."""
+        self.token_budget = max(1, token_budget)
+        self._dispatch()
+        logger.info(f"Admission token budget ({self.name}) set to {self.token_budget}")
+
+    async def admit(self, user_id: str, cost: int) -> _AdmissionTicket:
+        """Wait for budget for a request of the given cost, or raise AdmissionRejected."""
+        # A request larger than the whole budget runs alone rather than never
+        cost = max(1, min(cost, self.token_budget))
+        if not self._waiting and self.active_tokens + cost <= self.token_budget:
+            return self._grant(user_id, cost)
+
+        if self.queued_tokens + cost > self.max_queued_tokens:
+            raise self._reject("queue_full", f"{self.queued_tokens} tokens already queued")
+        # Each waiting user may hold an equal share of the queue, beyond their first request
+        users = len(self._waiting) + (user_id not in self._waiting)
+        user_queued = self._queued_by_user.get(user_id, 0)
+        if user_queued and user_queued + cost > self.max_queued_tokens / users:
+            raise self._reject("fair_share", f"{user_queued} tokens already queued for {user_id}")
+
+        waiter = _Waiter(user_id, cost, asyncio.get_running_loop().create_future())
+        self._waiting.setdefault(user_id, deque()).append(waiter)
+        self._queued_by_user[user_id] = user_queued + cost
+        self.queued_tokens += cost
+        self.queue_depth += 1
+        self._update_metrics()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except BaseException as e:
+            if waiter.future.done():
+                # Admitted just as the caller gave up
+                waiter.future.result().release()
+            else:
+                waiter.future.cancel()
+                self._dequeue(waiter)
+                self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("timeout", f"not admitted within {self.max_wait:g}s")
+            raise
+
+    def _reject(self, reason: str, message: str) -> AdmissionRejected:
+        ADMISSION_REJECTED.labels(reason=reason).inc()
+        return AdmissionRejected(reason, message)
+
+    def _grant(self, user_id: str, cost: int) -> _AdmissionTicket:
+        self.active_tokens += cost
+        self.active_requests += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + cost
+        self._update_metrics()
+        return _AdmissionTicket(self, user_id, cost)
+
+    def _release(self, ticket: _AdmissionTicket):
+        self.active_tokens -= ticket.cost
+        self.active_requests -= 1
+        remaining = self._active_by_user[ticket.user_id] - ticket.cost
+        if remaining:
+            self._active_by_user[ticket.user_id] = remaining
         else:
-            # Return a regular response
-            return await run_inference(request)
-    except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        processing_request = False
+            del self._active_by_user[ticket.user_id]
+        self._dispatch()
+        self._update_metrics()
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    logger.info(f"{request.method} {request.url.path} - {response.status_code} ({process_time:.2f}s)")
-    return response
+    def _dequeue(self, waiter: _Waiter):
+        waiters = self._waiting[waiter.user_id]
+        waiters.remove(waiter)
+        if not waiters:
+            del self._waiting[waiter.user_id]
+        remaining = self._queued_by_user[waiter.user_id] - waiter.cost
+        if remaining:
+            self._queued_by_user[waiter.user_id] = remaining
+        else:
+            del self._queued_by_user[waiter.user_id]
+        self.queued_tokens -= waiter.cost
+        self.queue_depth -= 1
+        self._update_metrics()
 
-if __name__ == "__main__":
-    import uvicorn
-    logger.info("Starting server on port 8080...")
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    def _dispatch(self):
+        """Admit waiting requests while the budget allows, fairest user first."""
+        while self._waiting:
+            user_id = min(self._waiting, key=lambda user: self._active_by_user.get(user, 0))
+            waiter = self._waiting[user_id][0]
+            if self.active_tokens + waiter.cost > self.token_budget:
+                break
+            self._dequeue(waiter)
+            if user_id in self._waiting:
+                # Users tied on tokens in flight take turns
+                self._waiting.move_to_end(user_id)
+            waiter.future.set_result(self._grant(user_id, waiter.cost))
+
+    def _update_metrics(self):
+        ADMISSION_QUEUE_DEPTH.labels(budget=self.name).set(self.queue_depth)
+        ADMISSION_QUEUED_TOKENS.labels(budget=self.name).set(self.queued_tokens)
+        ADMISSION_ACTIVE_TOKENS.labels(budget=self.name).set(self.active_tokens)
+
+admission = AdmissionController()
+# Streamed requests hold KV outside the engine's page pool, so with a pool they get a budget of their own
+stream_admission = AdmissionController("stream") if KV_CACHE_MAX_MB > 0 else admission
+logger.info(f"Admission control: {admission.token_budget} token budget, "
+            f"up to {admission.max_queued_tokens} tokens queued")
+
+# Prefix KV Cache
+# Prompts that share a long preamble reuse the keys/values already computed for
+# it. Entries hold the cache of a block-aligned prompt prefix and are indexed
+# by the chained hash of every block boundary they cover, so a new prompt finds
+# the longest cached prefix it shares with any earlier prompt.
+class _PrefixEntry:
+    def __init__(self, token_ids: tuple, past_key_values, nbytes: int, block_hashes: List[int]):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = nbytes
+        self.block_hashes = block_hashes
+
+class PrefixCache:
+    """LRU cache of prompt-prefix KV states under a memory budget."""
+
+    def __init__(self, model_name: str, block_tokens: int = PREFIX_CACHE_BLOCK_TOKENS,
+                 max_bytes: int = int(PREFIX_CACHE_MAX_MB * 1024 * 1024)):
+        self.model_name = model_name
+        self.block_tokens = max(1, block_tokens)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[int, _PrefixEntry]" = OrderedDict()
+        # Block-boundary hash -> {entry key: prefix length} of every entry covering it,
+        # so evicting one entry keeps the boundaries other entries still share
+        self._index: Dict[int, Dict[int, int]] = {}
+
+    def _block_hashes(self, token_ids: List[int]) -> List[int]:
+        hashes, running = [], 0
+        for end in range(self.block_tokens, len(token_ids) + 1, self.block_tokens):
+            running = hash((running, tuple(token_ids[end - self.block_tokens:end])))
+            hashes.append(running)
+        return hashes
+
+    def lookup(self, prompt_ids: List[int]):
+        """
+        Return (length, past_key_values) for the longest cached prefix of the prompt,
+        or (0, None). At least one prompt token is always left for the model to run.
+        """
+        hashes = self._block_hashes(prompt_ids[:-1])
+        for block_hash in reversed(hashes):
+            entry = None
+            for key, length in reversed(self._index.get(block_hash, {}).items()):
+                # Guard against hash collisions before trusting the entry
+                if self._entries[key].token_ids[:length] == tuple(prompt_ids[:length]):
+                    entry = self._entries[key]
+                    break
+            if entry is None:
+                continue
+            self._entries.move_to_end(key)
+            PREFIX_CACHE_HITS.labels(model=self.model_name).inc()
+            PREFIX_CACHE_TOKENS.labels(model=self.model_name).inc(length)
+            past_key_values = tuple(
+                (key_states[:, :, :length], value_states[:, :, :length])
+                for key_states, value_states in entry.past_key_values
+            )
+            return length, past_key_values
+
+        PREFIX_CACHE_MISSES.labels(model=self.model_name).inc()
+        return 0, None
+
+    def insert(self, prompt_ids: List[int], past_key_values):
+        """Store the block-aligned part of a prompt's cache, evicting LRU entries over budget."""
+        hashes = self._block_hashes(prompt_ids)
+        if not hashes:
+            return
+        key = hashes[-1]
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        length = len(hashes) * self.block_tokens
+        stored = tuple(
+            (key_states[:, :, :length].clone(), value_states[:, :, :length].clone())
+            for key_states, value_states in past_key_values
+        )
+        nbytes = sum(t.numel() * t.element_size() for layer in stored for t in layer)
+        if nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = _PrefixEntry(tuple(prompt_ids[:length]), stored, nbytes, hashes)
+        for block, block_hash in enumerate(hashes, start=1):
+            self._index.setdefault(block_hash, {})[key] = block * self.block_tokens
+        self.total_bytes += nbytes
+
+        while self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        key, entry = self._entries.popitem(last=False)
+        self.total_bytes -= entry.nbytes
+        for block_hash in entry.block_hashes:
+            owners = self._index.get(block_hash)
+            if owners is not None:
+                owners.pop(key, None)
+                if not owners:
+                    del self._index[block_hash]
+
+# Batched Sampling
+# Repetition penalty, temperature, top-k and top-p are applied as tensor ops
+# over a [batch, vocab] logits matrix with per-row settings, in the order
+# model.generate applies them, so one call samples every row of a decode step.
+class SamplingParams:
+    """Per-row sampling settings of a batch, shaped [batch, 1] to broadcast against logits."""
+
+    def __init__(self, requests: List[InferenceRequest], device: torch.device):
+        self.do_sample = torch.tensor([r.do_sample for r in requests], device=device)
+        self.repetition_penalty = torch.tensor([[r.repetition_penalty] for r in requests], device=device)
+        # Greedy rows skip the sampling warpers, as in model.generate
+        self.temperature = torch.tensor([[r.temperature if r.do_sample else 1.0] for r in requests], device=device)
+        self.top_k = torch.tensor([[r.top_k if r.do_sample else 0] for r in requests], device=device)
+        self.top_p = torch.tensor([[r.top_p if r.do_sample else 1.0] for r in requests], device=device)
+
+        self.any_sample = any(r.do_sample for r in requests)
+        self.any_penalty = any(r.repetition_penalty != 1.0 for r in requests)
+        self.any_filter = any(r.do_sample and (r.top_k > 0 or r.top_p < 1.0) for r in requests)
+
+def _pad_context(context_ids: List[List[int]], device: torch.device) -> torch.Tensor:
+    """Stack per-row token histories into [batch, longest], padded with -1."""
+    padded = torch.full((len(context_ids), max(len(ids) for ids in context_ids)), -1, dtype=torch.long)
+    for i, ids in enumerate(context_ids):
+        padded[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+    return padded.to(device)
+
+def process_logits(logits: torch.Tensor, context_ids: Optional[torch.Tensor], params: SamplingParams) -> torch.Tensor:
+    """
+    Turn raw [batch, vocab] logits into sampling scores; filtered tokens get -inf.
+    context_ids ([batch, length], -1 padded) is only read for the repetition penalty.
+    """
+    scores = logits.float()
+    vocab_size = scores.shape[-1]
+
+    if params.any_penalty:
+        # Pads (and ids past the vocab) land in a spare column that is dropped again
+        index = torch.where((context_ids < 0) | (context_ids >= vocab_size), vocab_size, context_ids)
+        seen = torch.zeros((scores.shape[0], vocab_size + 1), dtype=torch.bool, device=scores.device)
+        seen = seen.scatter_(1, index, True)[:, :vocab_size]
+        penalized = torch.where(scores < 0, scores * params.repetition_penalty, scores / params.repetition_penalty)
+        scores = torch.where(seen, penalized, scores)
+
+    if not params.any_sample:
+        return scores
+    scores = scores / params.temperature
+    if not params.any_filter:
+        return scores
+
+    # One descending sort serves both filters
+    sorted_scores, sorted_index = scores.sort(dim=-1, descending=True)
+    ranks = torch.arange(vocab_size, device=scores.device).unsqueeze(0)
+    remove = (params.top_k > 0) & (ranks >= params.top_k)
+    sorted_scores = sorted_scores.masked_fill(remove, -float("inf"))
+    # Nucleus: drop tokens once the higher-ranked ones already hold top_p of the mass
+    probs = torch.nn.functional.softmax(sorted_scores, dim=-1)
+    remove |= (params.top_p < 1.0) & (probs.cumsum(dim=-1) - probs >= params.top_p)
+    return scores.scatter(1, sorted_index, sorted_scores.masked_fill(remove, -float("inf")))
+
+def sample_tokens(scores: torch.Tensor, params: SamplingParams,
+                  generators: Optional[List[Optional[torch.Generator]]] = None):
+    """
+    Pick one token per row of processed scores: argmax for greedy rows, a draw
+    for sampling rows. Returns the tokens and the sampling distributions (None
+    when every row is greedy).
+    """
+    greedy = scores.argmax(dim=-1)
+    if not params.any_sample:
+        return greedy, None
+
+    probs = torch.nn.functional.softmax(scores, dim=-1)
+    # argmax(p / E) with E ~ Exp(1) is a draw from p; rows with their own
+    # generator (fixed seed) draw their own noise so batching does not change them
+    noise = torch.empty_like(probs).exponential_()
+    for i, generator in enumerate(generators or []):
+        if generator is not None:
+            noise[i].exponential_(generator=generator)
+    sampled = (probs / noise).argmax(dim=-1)
+    return torch.where(params.do_sample, sampled, greedy), probs
+
+# Continuous Batching Engine
+# Requests are queued as sequences and decoded together in one batch; new
+# sequences join the running batch between decode steps and leave it as soon
+# as they finish, so a long generation never holds up a short one.
+def _to_legacy_cache(past_key_values):
+    """Normalize a model cache into the legacy tuple of (key, value) pairs per layer."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+def _crop_cache(past_key_values, length: int):
+    """Keep the first length positions of a dynamic or legacy cache."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+_LOGITS_TO_KEEP_SUPPORT: Dict[type, bool] = {}
+
+def _supports_logits_to_keep(model) -> bool:
+    """Whether the model's forward can skip the LM head for positions we do not sample from."""
+    model = getattr(model, "_orig_mod", model)
+    model_type = type(model)
+    if model_type not in _LOGITS_TO_KEEP_SUPPORT:
+        _LOGITS_TO_KEEP_SUPPORT[model_type] = "logits_to_keep" in inspect.signature(model.forward).parameters
+    return _LOGITS_TO_KEEP_SUPPORT[model_type]
+
+class _KVState:
+    """One model's view of a sequence: its KV cache and the tokens it has not seen yet."""
+
+    def __init__(self, pending_ids: List[int]):
+        self.pending_ids = list(pending_ids)
+        self.past_key_values = None
+        self.past_length = 0
+
+    @property
+    def num_layers(self) -> int:
+        return len(self.past_key_values)
+
+    def truncate(self, length: int):
+        """Forget cached positions from length on (e.g. rejected draft tokens)."""
+        if length < self.past_length:
+            self.past_key_values = _crop_cache(self.past_key_values, length)
+            self.past_length = length
+
+    def layer_cache(self, layer: int) -> tuple:
+        """Keys and values of one layer, [heads, past_length, head_dim] each."""
+        key, value = self.past_key_values[layer]
+        return key[0], value[0]
+
+    def layer_parts(self, layer: int) -> List[tuple]:
+        """layer_cache as consecutive segments, so a caller copying it needs no concatenation first."""
+        return [self.layer_cache(layer)]
+
+    def store(self, cache, row: int, past_start: int, new_start: int):
+        """Keep row's positions [past_start, past_start + past_length) and [new_start, end) of a padded batch cache."""
+        end = cache[0][0].shape[2]
+        keep = torch.cat([
+            torch.arange(past_start, past_start + self.past_length),
+            torch.arange(new_start, end),
+        ]).to(cache[0][0].device)
+        self.past_key_values = tuple(
+            (key[row:row + 1].index_select(2, keep), value[row:row + 1].index_select(2, keep))
+            for key, value in cache
+        )
+        self.past_length += end - new_start
+
+    def load(self, past_key_values, length: int):
+        """Start from a cache of length positions (e.g. a cached prompt prefix)."""
+        self.past_key_values = past_key_values
+        self.past_length = length
+
+    def legacy_cache(self):
+        return self.past_key_values
+
+    def fork(self, other: "_KVState"):
+        """Continue from other's cache; tensors are never written in place, so they are shared as is."""
+        self.past_key_values = other.past_key_values
+        self.past_length = other.past_length
+
+    def release(self):
+        self.past_key_values = None
+        self.past_length = 0
+
+def _ragged_forward(model, states: List[_KVState], logits_to_keep: int = 1) -> torch.Tensor:
+    """
+    Run a ragged forward pass where every sequence feeds its pending tokens
+    on top of its own cache. Caches and new tokens are both left-padded,
+    pads are masked out and positions are given explicitly so each row
+    computes exactly what it would on its own. Returns the logits of the last
+    logits_to_keep positions, [batch, logits_to_keep, vocab].
+    """
+    past_lengths = [state.past_length for state in states]
+    new_lengths = [len(state.pending_ids) for state in states]
+    max_past, max_new = max(past_lengths), max(new_lengths)
+
+    # Any id works for padding, pad positions are masked out
+    input_ids = torch.zeros((len(states), max_new), dtype=torch.long)
+    position_ids = torch.zeros((len(states), max_new), dtype=torch.long)
+    attention_mask = torch.zeros((len(states), max_past + max_new), dtype=torch.long)
+    for i, state in enumerate(states):
+        past, new = past_lengths[i], new_lengths[i]
+        input_ids[i, max_new - new:] = torch.tensor(state.pending_ids, dtype=torch.long)
+        position_ids[i, max_new - new:] = torch.arange(past, past + new)
+        attention_mask[i, max_past - past:max_past] = 1
+        attention_mask[i, max_past + max_new - new:] = 1
+
+    model_inputs = {
+        "input_ids": input_ids.to(model.device),
+        "position_ids": position_ids.to(model.device),
+        "attention_mask": attention_mask.to(model.device),
+    }
+    if max_past:
+        model_inputs["past_key_values"] = DynamicCache.from_legacy_cache(_pack_cache(states, max_past))
+    if _supports_logits_to_keep(model):
+        model_inputs["logits_to_keep"] = logits_to_keep
+
+    outputs = model(**model_inputs, use_cache=True)
+    _unpack_cache(states, _to_legacy_cache(outputs.past_key_values), max_past, max_new)
+    return outputs.logits[:, -logits_to_keep:, :]
+
+def _pack_cache(states: List[_KVState], max_past: int):
+    """Left-pad every sequence's cache to max_past and stack them into one batch cache."""
+    num_layers = next(state.num_layers for state in states if state.past_length)
+    packed = []
+    for layer in range(num_layers):
+        parts = [state.layer_parts(layer) if state.past_length else None for state in states]
+        if len(states) == 1 and len(parts[0]) == 1:
+            # A lone sequence needs no padding, its cache is passed as is
+            key, value = parts[0][0]
+            packed.append((key.unsqueeze(0), value.unsqueeze(0)))
+            continue
+        ref_key, ref_value = next(segments[0] for segments in parts if segments)
+        keys = ref_key.new_zeros((len(states), ref_key.shape[0], max_past, ref_key.shape[2]))
+        values = ref_value.new_zeros((len(states), ref_value.shape[0], max_past, ref_value.shape[2]))
+        for i, segments in enumerate(parts):
+            position = max_past - states[i].past_length
+            for key, value in segments or ():
+                keys[i, :, position:position + key.shape[1]] = key
+                values[i, :, position:position + key.shape[1]] = value
+                position += key.shape[1]
+        packed.append((keys, values))
+    return tuple(packed)
+
+def _unpack_cache(states: List[_KVState], cache, max_past: int, max_new: int):
+    """Split the batch cache back into per-sequence caches without the padding."""
+    for i, state in enumerate(states):
+        state.store(cache, i, max_past - state.past_length, max_past + max_new - len(state.pending_ids))
+
+# Paged KV Cache
+# The engine's keys/values are budgeted in fixed-size pages of KV_BLOCK_TOKENS
+# tokens, drawn from one budget (KV_CACHE_MAX_MB) that every loaded model
+# shares, instead of being left to grow per request. Pages for prompt + max
+# new tokens are reserved when a request is admitted, so a running sequence
+# never runs out of memory and the budget bounds how many run at once across
+# all models. A sequence's pages back one buffer, allocated on its first write,
+# and new positions are written into it in place. The pages bound capacity
+# only, nothing is gathered out of a pool on every step: a lone sequence's
+# buffer goes to the model as is, while a ragged batch is still packed into
+# one padded cache per step (see _pack_cache). Extra return sequences read the
+# prompt from the first sequence's buffer and only hold pages for their output.
+class KVCacheFull(Exception):
+    """Raised when the KV budget has too few free pages for a request."""
+
+class KVMemoryBudget:
+    """KV cache memory shared by the batching engines of every loaded model, in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        # Bytes per token of MODEL_NAME's cache; admission counts tokens at this size
+        self.token_bytes = 0
+        # Pages are returned on the event loop, but may be taken on the inference executor
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._released: Optional[asyncio.Event] = None
+        KV_CACHE_BUDGET_BYTES.set(max_bytes)
+
+    @property
+    def free_bytes(self) -> int:
+        return self.max_bytes - self.used_bytes
+
+    @property
+    def capacity_tokens(self) -> int:
+        return self.max_bytes // self.token_bytes if self.token_bytes else 0
+
+    def reserve(self, nbytes: int):
+        with self._lock:
+            if nbytes > self.max_bytes - self.used_bytes:
+                raise KVCacheFull(f"{nbytes} bytes of KV cache requested, "
+                                  f"{self.max_bytes - self.used_bytes} of {self.max_bytes} free")
+            self.used_bytes += nbytes
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.used_bytes -= nbytes
+        if nbytes and self._released is not None:
+            self._loop.call_soon_threadsafe(self._released.set)
+
+    async def wait_for_release(self):
+        """Wait until any model returns pages, e.g. for a request that waits on another model's sequences."""
+        if self._released is None:
+            self._loop = asyncio.get_running_loop()
+            self._released = asyncio.Event()
+        self._released.clear()
+        await self._released.wait()
+
+kv_budget = KVMemoryBudget(int(KV_CACHE_MAX_MB * 1024 ** 2)) if KV_CACHE_MAX_MB > 0 else None
+
+class KVBlockPool:
+    """One model's pages of the shared KV budget: its cache layout and the pages its sequences hold."""
+
+    def __init__(self, model, model_name: str, budget: KVMemoryBudget, block_tokens: int = KV_BLOCK_TOKENS):
+        # One-token forward to learn the cache layout (layers, heads, head size, dtype) of any architecture
+        with torch.inference_mode():
+            outputs = model(input_ids=torch.zeros((1, 1), dtype=torch.long, device=model.device), use_cache=True)
+        probe = _to_legacy_cache(outputs.past_key_values)
+        _, self.heads, _, self.head_dim = probe[0][0].shape
+
+        self.model_name = model_name
+        self.budget = budget
+        self.device = model.device
+        self.dtype = probe[0][0].dtype
+        self.block_tokens = max(1, block_tokens)
+        self.num_layers = len(probe)
+        self.token_bytes = 2 * self.num_layers * self.heads * self.head_dim * probe[0][0].element_size()
+        self.block_bytes = self.token_bytes * self.block_tokens
+        self.used_blocks = 0
+        KV_CACHE_USED_BYTES.labels(model=model_name).set(0)
+
+    @property
+    def num_blocks(self) -> int:
+        """Pages of this model the whole budget holds."""
+        return self.budget.max_bytes // self.block_bytes
+
+    @property
+    def free_blocks(self) -> int:
+        return self.budget.free_bytes // self.block_bytes
+
+    def blocks_for(self, tokens: int) -> int:
+        return -(-tokens // self.block_tokens)
+
+    def allocate(self, count: int):
+        self.budget.reserve(count * self.block_bytes)
+        self.used_blocks += count
+        KV_CACHE_USED_BYTES.labels(model=self.model_name).set(self.used_blocks * self.block_bytes)
+
+    def release(self, count: int):
+        self.used_blocks -= count
+        self.budget.release(count * self.block_bytes)
+        KV_CACHE_USED_BYTES.labels(model=self.model_name).set(self.used_blocks * self.block_bytes)
+
+    def buffers(self, capacity: int) -> List[tuple]:
+        """Uninitialised keys/values for capacity positions, [heads, capacity, head_dim] per layer."""
+        shape = (self.heads, capacity, self.head_dim)
+        return [(torch.empty(shape, dtype=self.dtype, device=self.device),
+                 torch.empty(shape, dtype=self.dtype, device=self.device)) for _ in range(self.num_layers)]
+
+class _PagedKVState(_KVState):
+    """A _KVState whose cache is one buffer backed by pages of the KV budget, written in place."""
+
+    def __init__(self, pool: KVBlockPool, pending_ids: List[int]):
+        super().__init__(pending_ids)
+        self.pool = pool
+        # Pages reserved for this sequence; its buffer holds as many positions
+        self.blocks = 0
+        self.buffers: Optional[List[tuple]] = None
+        # A forked sequence reads positions [0, shared_length) from its source's buffer
+        self.source: Optional["_PagedKVState"] = None
+        self.shared_length = 0
+        # Forks still reading this buffer; its pages are only returned once they are done
+        self.readers = 0
+        self.released = False
+
+    @property
+    def num_layers(self) -> int:
+        return self.pool.num_layers
+
+    def reserve(self, count: int):
+        self.pool.allocate(count)
+        self.blocks += count
+
+    def truncate(self, length: int):
+        # The positions are simply written again
+        self.past_length = max(self.shared_length, min(self.past_length, length))
+
+    def layer_parts(self, layer: int) -> List[tuple]:
+        parts = []
+        if self.source is not None:
+            key, value = self.source.buffers[layer]
+            parts.append((key[:, :self.shared_length], value[:, :self.shared_length]))
+        own = self.past_length - self.shared_length
+        if own:
+            key, value = self.buffers[layer]
+            parts.append((key[:, :own], value[:, :own]))
+        return parts
+
+    def layer_cache(self, layer: int) -> tuple:
+        parts = self.layer_parts(layer)
+        if len(parts) == 1:
+            return parts[0]
+        return torch.cat([key for key, _ in parts], dim=1), torch.cat([value for _, value in parts], dim=1)
+
+    def store(self, cache, row: int, past_start: int, new_start: int):
+        # Earlier positions are already in the buffer - only the new ones are written
+        self._write(self.past_length, [(key[row, :, new_start:], value[row, :, new_start:]) for key, value in cache])
+
+    def load(self, past_key_values, length: int):
+        self.past_length = 0
+        self._write(0, [(key[0, :, :length], value[0, :, :length]) for key, value in past_key_values])
+
+    def legacy_cache(self):
+        return tuple(
+            (key.unsqueeze(0), value.unsqueeze(0))
+            for key, value in (self.layer_cache(layer) for layer in range(self.num_layers))
+        )
+
+    def fork(self, other: "_PagedKVState"):
+        # The source only writes past its current length, so the shared positions never change
+        self.source = other
+        other.readers += 1
+        self.shared_length = self.past_length = other.past_length
+
+    def release(self):
+        if self.source is not None:
+            source, self.source = self.source, None
+            source.readers -= 1
+            if source.released and not source.readers:
+                source._return_pages()
+        self.released = True
+        if not self.readers:
+            self._return_pages()
+
+    def _return_pages(self):
+        self.pool.release(self.blocks)
+        self.blocks, self.buffers = 0, None
+        self.past_length = self.shared_length = 0
+
+    def _write(self, start: int, layers: List[tuple]):
+        """Write [heads, count, head_dim] keys/values per layer at positions start.. of the sequence."""
+        count = layers[0][0].shape[1]
+        offset = start - self.shared_length
+        capacity = self.blocks * self.pool.block_tokens
+        if offset + count > capacity:
+            # Beyond what admission reserved, e.g. speculative drafts near the end
+            self.reserve(self.pool.blocks_for(offset + count) - self.blocks)
+        if self.buffers is None or self.buffers[0][0].shape[1] < self.blocks * self.pool.block_tokens:
+            buffers = self.pool.buffers(self.blocks * self.pool.block_tokens)
+            if self.buffers is not None:
+                for (key, value), (old_key, old_value) in zip(buffers, self.buffers):
+                    key[:, :offset], value[:, :offset] = old_key[:, :offset], old_value[:, :offset]
+            self.buffers = buffers
+        for (key, value), (new_key, new_value) in zip(self.buffers, layers):
+            key[:, offset:offset + count] = new_key
+            value[:, offset:offset + count] = new_value
+        self.past_length = start + count
+
+# Speculative Decoding
+# A small draft model sharing the tokenizer proposes up to SPECULATIVE_TOKENS
+# tokens, one cheap forward pass each; the main model scores all of them in a
+# single forward pass. Accepted tokens follow the main model's distribution
+# exactly (rejection sampling), so outputs are unchanged - only faster when
+# the draft agrees with the main model often.
+def _verify_draft(target_logits: torch.Tensor, draft_ids: List[int], draft_probs: List[Optional[torch.Tensor]],
+                  context_ids: List[int], request: InferenceRequest, generator: Optional[torch.Generator] = None):
+    """
+    Check draft tokens against the main model's logits for [last token] + drafts.
+    Returns how many drafts were accepted and the token to emit after them: the
+    correction for the first rejected draft, or a bonus token if all passed.
+    """
+    # Row j scores the position after context + draft_ids[:j]; all rows in one call
+    params = SamplingParams([request] * (len(draft_ids) + 1), target_logits.device)
+    history = None
+    if params.any_penalty:
+        history = _pad_context([context_ids + draft_ids[:j] for j in range(len(draft_ids) + 1)], target_logits.device)
+    scores = process_logits(target_logits, history, params)
+
+    if not request.do_sample:
+        best = scores.argmax(dim=-1).tolist()
+        for j, draft_id in enumerate(draft_ids):
+            if best[j] != draft_id:
+                return j, best[j]
+        return len(draft_ids), best[-1]
+
+    p = torch.nn.functional.softmax(scores, dim=-1)
+    q = torch.stack(draft_probs)
+    drafts = torch.tensor(draft_ids, device=p.device).unsqueeze(1)
+    # Accept draft j with probability min(1, p/q), otherwise resample from max(0, p - q)
+    draws = torch.rand(len(draft_ids), generator=generator, device=p.device)
+    rejected = (draws * q.gather(1, drafts).squeeze(1) > p[:-1].gather(1, drafts).squeeze(1)).nonzero()
+    if len(rejected):
+        j = int(rejected[0])
+        residual = (p[j] - q[j]).clamp(min=0)
+        if residual.sum() <= 0:
+            residual = p[j]
+        return j, int(torch.multinomial(residual / residual.sum(), num_samples=1, generator=generator))
+    return len(draft_ids), int(torch.multinomial(p[-1], num_samples=1, generator=generator))
+
+def _rewind_draft(draft: _KVState, draft_ids: List[int], accepted: int, token_id: int):
+    """
+    Roll the draft state back to the accepted tokens. The draft cache holds all
+    but the last proposal; anything accepted but not yet seen is fed next step.
+    """
+    seen = min(accepted, len(draft_ids) - 1)
+    draft.truncate(draft.past_length - (len(draft_ids) - 1 - seen))
+    draft.pending_ids = draft_ids[seen:accepted] + [token_id]
+
+def _record_speculation(model_name: str, proposed: int, accepted: int):
+    SPECULATIVE_PROPOSED.labels(model=model_name).inc(proposed)
+    SPECULATIVE_ACCEPTED.labels(model=model_name).inc(accepted)
+    # Every verification is one forward pass of the main model
+    SPECULATIVE_TOKENS_PER_FORWARD.labels(model=model_name).observe(accepted + 1)
+
+class _Sequence:
+    """Decoding state of a single request inside the batching engine."""
+
+    def __init__(self, prompt_ids: List[int], request: InferenceRequest, max_new_tokens: int,
+                 future: asyncio.Future, generator: Optional[torch.Generator] = None,
+                 speculative: bool = False, queued_at: Optional[float] = None,
+                 kv_pool: Optional[KVBlockPool] = None):
+        self.prompt_ids = prompt_ids
+        self.request = request
+        self.max_new_tokens = max_new_tokens
+        self.future = future
+        self.generator = generator
+        self.enqueued_at = time.monotonic()
+        # Wall-clock start of the request's wait, for queue wait and time to first token
+        self.queued_at = queued_at if queued_at is not None else time.time()
+
+        # The main model has seen nothing yet - the whole prompt is pending until prefill
+        self.kv = _PagedKVState(kv_pool, prompt_ids) if kv_pool is not None else _KVState(prompt_ids)
+        # The draft model keeps its own cache of the same tokens
+        self.draft = _KVState(prompt_ids) if speculative else None
+        self.output_ids: List[int] = []
+        self.finished = False
+
+        # Further return sequences of the request; they fork this one's cache once the prompt is prefilled
+        self.siblings: List[_Sequence] = []
+        # Set on a sibling until it has forked
+        self.leader: Optional[_Sequence] = None
+        self.forked = False
+        # Set on admission when the prefix cache should be consulted before the first prefill
+        self.prefix_lookup = False
+
+    @property
+    def rows(self) -> int:
+        """Batch rows this sequence takes together with its siblings."""
+        return 1 + len(self.siblings)
+
+    @property
+    def draft_budget(self) -> int:
+        """Tokens worth proposing this step: decoding, and leaving room for the main model's own token."""
+        if self.draft is None or not self.output_ids:
+            return 0
+        return min(SPECULATIVE_TOKENS, self.max_new_tokens - len(self.output_ids) - 1)
+
+# Length Buckets
+# Rows of one forward pass are left-padded to its longest row, so a 500-token
+# prompt batched with 10-token ones (or with sequences decoding one token at a
+# time) mostly computes padding. Waiting sequences are grouped by prompt length
+# and max new tokens and admitted one bucket at a time; each step's forward
+# passes are split along the same length bounds.
+def _length_groups(lengths: List[int], bounds: List[int]) -> List[List[int]]:
+    """Indices of lengths grouped by the bucket bounds they fall under, shortest bucket first."""
+    groups: Dict[int, List[int]] = {}
+    for i, length in enumerate(lengths):
+        groups.setdefault(bisect.bisect_left(bounds, length), []).append(i)
+    return [groups[bucket] for bucket in sorted(groups)]
+
+class LengthBuckets:
+    """Waiting sequences grouped by (prompt length, max new tokens) bucket, oldest first within each."""
+
+    def __init__(self, prompt_bounds: List[int] = LENGTH_BUCKETS, new_token_bounds: List[int] = NEW_TOKEN_BUCKETS,
+                 max_wait: float = LENGTH_BUCKET_MAX_WAIT_MS / 1000):
+        self.prompt_bounds = sorted(prompt_bounds)
+        self.new_token_bounds = sorted(new_token_bounds)
+        self.max_wait = max(0.0, max_wait)
+        self._buckets: Dict[tuple, Deque[_Sequence]] = {}
+
+    def __len__(self) -> int:
+        return sum(seq.rows for bucket in self._buckets.values() for seq in bucket)
+
+    def __iter__(self):
+        for bucket in self._buckets.values():
+            yield from bucket
+
+    def key(self, seq: _Sequence) -> tuple:
+        return (bisect.bisect_left(self.prompt_bounds, len(seq.prompt_ids)),
+                bisect.bisect_left(self.new_token_bounds, seq.max_new_tokens))
+
+    def append(self, seq: _Sequence):
+        self._buckets.setdefault(self.key(seq), deque()).append(seq)
+
+    def requeue(self, sequences: List[_Sequence]):
+        """Put taken sequences back at the front of their buckets."""
+        for seq in reversed(sequences):
+            self._buckets.setdefault(self.key(seq), deque()).appendleft(seq)
+
+    def clear(self):
+        self._buckets.clear()
+
+    @property
+    def oldest_enqueued_at(self) -> float:
+        return min(bucket[0].enqueued_at for bucket in self._buckets.values())
+
+    def take(self, limit: int, force: bool = False) -> List[_Sequence]:
+        """
+        Pop sequences of up to limit rows from one bucket: the longest waiting
+        bucket past max_wait, else one that fills limit on its own, else (with
+        force) the fullest. Returns nothing when every bucket should keep waiting.
+        """
+        if not self._buckets or limit <= 0:
+            return []
+        now = time.monotonic()
+        by_age = sorted(self._buckets, key=lambda key: self._buckets[key][0].enqueued_at)
+        key = next((key for key in by_age if now - self._buckets[key][0].enqueued_at >= self.max_wait), None)
+        if key is None:
+            fullest = max(by_age, key=lambda key: len(self._buckets[key]))
+            if force or len(self._buckets[fullest]) >= limit:
+                key = fullest
+        if key is None:
+            return []
+        bucket = self._buckets[key]
+        taken, rows = [], 0
+        while bucket and rows + bucket[0].rows <= limit:
+            rows += bucket[0].rows
+            taken.append(bucket.popleft())
+        if not taken and force:
+            # A request with more return sequences than free rows runs once the engine is idle
+            taken.append(bucket.popleft())
+        if not bucket:
+            del self._buckets[key]
+        return taken
+
+class BatchingEngine:
+    """
+    Background scheduler that runs continuous batching over one model.
+    The scheduling loop lives on the event loop; the forward passes run on the
+    inference executor so the loop stays free for other endpoints.
+    """
+
+    def __init__(self, model, tokenizer, model_name: str, executor: InferenceExecutor,
+                 prefix_cache: Optional[PrefixCache] = None,
+                 decode_model=None,
+                 draft_model=None,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_queue_wait: float = MAX_QUEUE_WAIT_MS / 1000,
+                 prefill_chunk: int = PREFILL_CHUNK_TOKENS,
+                 kv_pool: Optional[KVBlockPool] = None):
+        self.model = model
+        # Used for steps where every sequence feeds a single token
+        self.decode_model = decode_model or model
+        # Proposes tokens for the main model to verify (speculative decoding)
+        self.draft_model = draft_model
+        self.executor = executor
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.model_name = model_name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_queue_wait = max(0.0, max_queue_wait)
+        self.prefill_chunk = max(0, prefill_chunk)
+        # Pages for the main model's caches; None keeps per-sequence cache tensors
+        self.kv_pool = kv_pool
+        self.device = model.device
+        self.eos_token_id = tokenizer.eos_token_id
+
+        self._waiting = LengthBuckets()
+        self._running: List[_Sequence] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._running)
+
+    def start(self):
+        """Start the scheduling loop on the running event loop (idempotent)."""
+        if self._task is None:
+            # Created here rather than in __init__ so it binds to uvicorn's loop
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info(f"Batching engine started for {self.model_name} "
+                        f"(max_batch_size={self.max_batch_size}, max_queue_wait={self.max_queue_wait * 1000:.0f}ms, "
+                        f"speculative={self.draft_model is not None})")
+
+    async def stop(self):
+        """Stop the scheduling loop, failing any sequence it still holds."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for seq in list(self._waiting) + self._running:
+            for member in [seq] + seq.siblings:
+                if not member.future.done():
+                    member.future.cancel()
+                member.kv.release()
+        self._waiting.clear()
+        self._running = []
+        self._update_gauges()
+
+    async def generate(self, prompt_ids: List[int], request: InferenceRequest, max_new_tokens: int,
+                       queued_at: Optional[float] = None) -> List[List[int]]:
+        """
+        Queue a prompt for generation and wait for the completion token ids of each
+        of its num_return_sequences sequences. Extra sequences are extra batch rows.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        sequences = []
+        for index in range(request.num_return_sequences):
+            # A per-sequence generator keeps seeded output independent of batch composition
+            generator = None
+            if request.seed is not None:
+                generator = torch.Generator(device=self.device).manual_seed(request.seed + index)
+            sequences.append(_Sequence(prompt_ids, request, max_new_tokens, loop.create_future(), generator,
+                                       speculative=self.draft_model is not None, queued_at=queued_at,
+                                       kv_pool=self.kv_pool))
+        # The prompt is prefilled once; the other sequences fork its cache
+        leader = sequences[0]
+        leader.siblings = sequences[1:]
+        for sibling in leader.siblings:
+            sibling.leader = leader
+        self._waiting.append(leader)
+        futures = [seq.future for seq in sequences]
+        self._update_gauges()
+        self._wakeup.set()
+        try:
+            return list(await asyncio.gather(*futures))
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+
+    async def _run(self):
+        while True:
+            if not self._running and not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            # An idle engine gives concurrent arrivals a moment to fill the first batch
+            if not self._running:
+                await self._collect_batch()
+
+            self._admit()
+            if not self._running:
+                if self._waiting and self.kv_pool is not None:
+                    # The pages are held by other models' sequences
+                    await self.kv_pool.budget.wait_for_release()
+                continue
+
+            batch = list(self._running)
+            generated = [len(seq.output_ids) for seq in batch]
+            BATCH_SIZE.labels(model=self.model_name, streaming="false").set(len(batch))
+            step_start = time.time()
+            try:
+                await self.executor.run(self._step, batch)
+            except Exception as e:
+                logger.error(f"Batched decode step failed: {e}")
+                for seq in batch:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                    seq.kv.release()
+                self._running = []
+                self._update_gauges()
+                continue
+            self._record_step(batch, generated, step_start)
+
+            self._retire()
+
+    async def _collect_batch(self):
+        deadline = self._waiting.oldest_enqueued_at + self.max_queue_wait
+        while len(self._waiting) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+
+    def _admit(self):
+        while True:
+            # An idle engine always admits; a busy one only buckets that are full or overdue
+            admitted = self._waiting.take(self.max_batch_size - len(self._running), force=not self._running)
+            if not admitted:
+                return
+            for index, seq in enumerate(admitted):
+                if not self._admit_sequence(seq):
+                    # Out of KV pages: wait for running sequences to free theirs
+                    self._waiting.requeue(admitted[index:])
+                    return
+
+    def _admit_sequence(self, seq: _Sequence) -> bool:
+        """Move a request's sequences into the running batch; False if its KV pages do not fit yet."""
+        group = [seq] + seq.siblings
+        # Skip requests whose caller already went away (cancelled on disconnect)
+        if all(member.future.done() for member in group):
+            return True
+        if self.kv_pool is not None:
+            try:
+                self._reserve_pages(seq)
+            except KVCacheFull as e:
+                if self._running or self.kv_pool.budget.used_bytes:
+                    return False
+                # No sequence of any model will free pages - the request can never fit
+                logger.warning(f"Request does not fit the KV cache: {e}")
+                for member in group:
+                    if not member.future.done():
+                        member.future.set_exception(e)
+                return True
+        # The cached prefix is copied in by the first step, on the executor rather than the event loop
+        seq.prefix_lookup = self.prefix_cache is not None
+        self._running.extend(group)
+        QUEUE_WAIT_SECONDS.labels(model=self.model_name, streaming="false").observe(max(0.0, time.time() - seq.queued_at))
+        return True
+
+    def _reserve_pages(self, seq: _Sequence):
+        """
+        Reserve every page a request can use, so it never runs out mid-generation.
+        Siblings read the prompt from the leader's buffer and only reserve
+        pages for their own output.
+        """
+        pool = self.kv_pool
+        needs = [pool.blocks_for(len(seq.prompt_ids) + seq.max_new_tokens)]
+        needs += [pool.blocks_for(seq.max_new_tokens)] * len(seq.siblings)
+        if sum(needs) > pool.free_blocks:
+            raise KVCacheFull(f"{sum(needs)} KV pages needed, {pool.free_blocks} of {pool.num_blocks} free")
+        for member, count in zip([seq] + seq.siblings, needs):
+            member.kv.reserve(count)
+
+    def _record_step(self, batch: List[_Sequence], generated: List[int], step_start: float):
+        """Observe time to first token for prefilled sequences and per-token latency for decoding ones."""
+        now = time.time()
+        for seq, before in zip(batch, generated):
+            new_tokens = len(seq.output_ids) - before
+            if not new_tokens:
+                continue
+            if before == 0:
+                TIME_TO_FIRST_TOKEN.labels(model=self.model_name, streaming="false").observe(now - seq.queued_at)
+            else:
+                # A speculative step emits several tokens for one step's latency
+                DECODE_TOKEN_SECONDS.labels(model=self.model_name, streaming="false").observe((now - step_start) / new_tokens)
+
+    def _update_gauges(self):
+        INFLIGHT_SEQUENCES.labels(model=self.model_name, streaming="false").set(len(self._waiting) + len(self._running))
+        if not self._running:
+            BATCH_SIZE.labels(model=self.model_name, streaming="false").set(0)
+
+    def _retire(self):
+        still_running = []
+        for seq in self._running:
+            if seq.future.done():
+                seq.kv.release()
+                continue
+            if seq.finished:
+                seq.future.set_result(seq.output_ids)
+                seq.kv.release()
+            else:
+                still_running.append(seq)
+        self._running = still_running
+        self._update_gauges()
+
+    def _step(self, batch: List[_Sequence]):
+        """
+        One engine iteration: prefill new sequences and decode the rest - one
+        token each, or up to SPECULATIVE_TOKENS + 1 with a draft model.
+        Prefix cache lookups and inserts run here too, so copying cached
+        keys/values never blocks the event loop.
+        """
+        prefix_cache = self.prefix_cache
+        for seq in batch:
+            if seq.prefix_lookup:
+                seq.prefix_lookup = False
+                if prefix_cache is not None:
+                    # Start from the longest cached prefix and only prefill the rest
+                    length, past_key_values = prefix_cache.lookup(seq.prompt_ids)
+                    if length:
+                        seq.kv.load(past_key_values, length)
+                        seq.kv.pending_ids = seq.prompt_ids[length:]
+
+        batch, held = self._plan_prefill(batch)
+        with torch.inference_mode():
+            proposals = self._propose(batch) if self.draft_model is not None else {}
+            for seq, (draft_ids, _) in proposals.items():
+                seq.kv.pending_ids = seq.kv.pending_ids + draft_ids
+
+            # Prefilling and decoding rows run in separate forward passes, each padded only to its own bucket
+            logits: List[Optional[torch.Tensor]] = [None] * len(batch)
+            pending = [len(seq.kv.pending_ids) for seq in batch]
+            groups = []
+            for phase in ([i for i, seq in enumerate(batch) if seq.output_ids],
+                          [i for i, seq in enumerate(batch) if not seq.output_ids]):
+                groups.extend([phase[j] for j in group]
+                              for group in _length_groups([pending[i] for i in phase], self._waiting.prompt_bounds))
+            for rows in groups:
+                group = [batch[i] for i in rows]
+                single_token = all(pending[i] == 1 for i in rows)
+                forward_model = self.decode_model if single_token else self.model
+                keep = 1 + max((len(proposals[seq][0]) for seq in group if seq in proposals), default=0)
+                # Rows attend over their cache left-padded to the longest one, so that padding counts too
+                past = [seq.kv.past_length for seq in group]
+                PADDING_EFFICIENCY.labels(model=self.model_name).observe(
+                    (sum(past) + sum(pending[i] for i in rows))
+                    / (len(rows) * (max(past) + max(pending[i] for i in rows))))
+                group_logits = _ragged_forward(forward_model, [seq.kv for seq in group], keep)
+                for j, i in enumerate(rows):
+                    logits[i] = group_logits[j]
+
+            # Siblings fork the leader's cache once its prompt is prefilled and sample from its logits
+            for i, seq in enumerate(list(batch)):
+                if seq.siblings and seq not in held and not seq.output_ids:
+                    for sibling in seq.siblings:
+                        sibling.kv.fork(seq.kv)
+                        sibling.leader, sibling.forked = None, True
+                        batch.append(sibling)
+                        logits.append(logits[i])
+                    seq.siblings = []
+
+            # Sequences without drafts are sampled together in one call; partly prefilled ones sample nothing yet
+            plain = [i for i, seq in enumerate(batch) if seq not in proposals and seq not in held]
+            sampled = {}
+            if plain:
+                tokens, _ = self._sample(torch.stack([logits[i][-1] for i in plain]), [batch[i] for i in plain])
+                sampled = dict(zip(plain, tokens))
+
+            for i, seq in enumerate(batch):
+                if seq in held:
+                    seq.kv.pending_ids = held[seq]
+                    continue
+                if seq in proposals:
+                    draft_ids, draft_probs = proposals[seq]
+                    accepted, token_id = _verify_draft(
+                        logits[i][-(len(draft_ids) + 1):], draft_ids, draft_probs,
+                        seq.prompt_ids + seq.output_ids, seq.request, seq.generator
+                    )
+                    # Rejected drafts leave the main model's cache too
+                    seq.kv.truncate(seq.kv.past_length - (len(draft_ids) - accepted))
+                    _rewind_draft(seq.draft, draft_ids, accepted, token_id)
+                    _record_speculation(self.model_name, len(draft_ids), accepted)
+                    new_tokens = draft_ids[:accepted] + [token_id]
+                else:
+                    token_id = sampled[i]
+                    new_tokens = [token_id]
+                    if seq.draft is not None:
+                        seq.draft.pending_ids.append(token_id)
+
+                seq.kv.pending_ids = [new_tokens[-1]]
+                for token_id in new_tokens:
+                    seq.output_ids.append(token_id)
+                    if token_id == self.eos_token_id or len(seq.output_ids) >= seq.max_new_tokens:
+                        seq.finished = True
+                        break
+
+            if prefix_cache is not None:
+                # Sequences that just finished prefill hold the KV of their whole prompt
+                for seq in batch:
+                    if len(seq.output_ids) == 1 and not seq.forked:
+                        prefix_cache.insert(seq.prompt_ids, seq.kv.legacy_cache())
+
+    def _plan_prefill(self, batch: List[_Sequence]) -> tuple:
+        """
+        Split prefill into chunks: returns the rows that run this step and the
+        prompt tokens held back from each partly prefilled row. Decoding rows
+        always run; prefilling rows share prefill_chunk tokens, oldest first,
+        and wait for the next step once those are spent.
+        """
+        # Siblings join once their leader's prompt is prefilled
+        batch = [seq for seq in batch if seq.leader is None]
+        if not self.prefill_chunk:
+            return batch, {}
+        budget = self.prefill_chunk
+        rows, held = [], {}
+        for seq in batch:
+            if seq.output_ids:
+                rows.append(seq)
+                continue
+            if budget <= 0:
+                continue
+            pending = seq.kv.pending_ids
+            if len(pending) > budget:
+                seq.kv.pending_ids, held[seq] = pending[:budget], pending[budget:]
+            budget -= len(seq.kv.pending_ids)
+            rows.append(seq)
+        return rows, held
+
+    def _propose(self, batch: List[_Sequence]) -> Dict[_Sequence, tuple]:
+        """Let the draft model propose tokens for every decoding sequence, one ragged forward per token."""
+        proposals = {seq: ([], []) for seq in batch if seq.draft_budget > 0}
+        while True:
+            rows = [seq for seq, (draft_ids, _) in proposals.items() if len(draft_ids) < seq.draft_budget]
+            if not rows:
+                return proposals
+            logits = _ragged_forward(self.draft_model, [seq.draft for seq in rows])
+            tokens, probs = self._sample(logits[:, -1], rows, [proposals[seq][0] for seq in rows])
+            for i, seq in enumerate(rows):
+                draft_ids, draft_probs = proposals[seq]
+                draft_ids.append(tokens[i])
+                draft_probs.append(probs[i] if probs is not None else None)
+                seq.draft.pending_ids = [tokens[i]]
+
+    def _sample(self, logits: torch.Tensor, batch: List[_Sequence], draft_ids: Optional[List[List[int]]] = None):
+        """Sample the next token of every sequence in one call; draft_ids extend each sequence's history."""
+        params = SamplingParams([seq.request for seq in batch], logits.device)
+        history = None
+        if params.any_penalty:
+            history = _pad_context([
+                seq.prompt_ids + seq.output_ids + (draft_ids[i] if draft_ids else []) for i, seq in enumerate(batch)
+            ], logits.device)
+        tokens, probs = sample_tokens(process_logits(logits, history, params), params, [seq.generator for seq in batch])
+        return tokens.tolist(), probs
+
+# Response Cache
+# Identical requests (gateway retries, re-submitted prompts) are answered from a
+# cache instead of running the model again. Only requests whose output is
+# reproducible (greedy or fixed seed) or that explicitly opt in are cached.
+def _is_cacheable(request: InferenceRequest) -> bool:
+    return request.cache or not request.do_sample or request.seed is not None
+
+class ResponseCache:
+    """In-process LRU/TTL cache of InferenceResponses, optionally shared through Redis."""
+
+    def __init__(self, model_name: str, max_entries: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS, use_redis: bool = RESPONSE_CACHE_USE_REDIS):
+        self.model_name = model_name
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.use_redis = use_redis
+        # key -> (expires_at, serialized InferenceResponse)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def key(self, request: InferenceRequest) -> str:
+        params = request.model_dump(exclude={"stream", "cache", "user_id"})
+        params["model"] = request.model or self.model_name
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str, model_name: Optional[str] = None) -> Optional[InferenceResponse]:
+        model_name = model_name or self.model_name
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, payload = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                RESPONSE_CACHE_HITS.labels(model=model_name).inc()
+                return InferenceResponse.model_validate_json(payload)
+            del self._entries[key]
+
+        redis_client = get_redis() if self.use_redis else None
+        if redis_client is not None:
+            try:
+                payload = await redis_client.get(f"ml:response:{key}")
+            except Exception as e:
+                logger.warning(f"Response cache Redis lookup failed: {e}")
+                payload = None
+            if payload is not None:
+                self._store_local(key, payload)
+                RESPONSE_CACHE_HITS.labels(model=model_name).inc()
+                return InferenceResponse.model_validate_json(payload)
+
+        RESPONSE_CACHE_MISSES.labels(model=model_name).inc()
+        return None
+
+    async def put(self, key: str, response: InferenceResponse):
+        payload = response.model_dump_json()
+        self._store_local(key, payload)
+
+        redis_client = get_redis() if self.use_redis else None
+        if redis_client is not None:
+            try:
+                await redis_client.set(f"ml:response:{key}", payload, ex=max(1, int(self.ttl)))
+            except Exception as e:
+                logger.warning(f"Response cache Redis store failed: {e}")
+
+    def _store_local(self, key: str, payload):
+        self._entries[key] = (time.time() + self.ttl, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+response_cache = ResponseCache(MODEL_NAME) if RESPONSE_CACHE_ENABLED else None
+
+async def _cached_response(request: InferenceRequest, start_time: float) -> Optional[InferenceResponse]:
+    """Look a request up in the response cache; done before any model lease, admission or slot is taken."""
+    if response_cache is None or not _is_cacheable(request):
+        return None
+    model_name = request.model or MODEL_NAME
+    # Unknown models are answered 404 by the lease, and must not create metric labels
+    if model_name not in model_registry.served_names:
+        return None
+    cached_response = await response_cache.get(response_cache.key(request), model_name)
+    if cached_response is None:
+        return None
+    logger.info("Inference served from response cache")
+    return cached_response.model_copy(update={"cached": True, "processing_time": time.time() - start_time})
+
+# Separate function to do the actual inference
+def _streaming_label(stream: bool) -> str:
+    return "true" if stream else "false"
+
+def _tokenize_prompts(served: "ServedModel", prompts: List[str], stream: bool = False) -> List[List[int]]:
+    """Tokenize prompts in one call without padding - the engine pads when it batches."""
+    tokenize_start = time.perf_counter()
+    tokenizer = served.tokenizer
+    fallback = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else tokenizer.eos_token_id
+    # An empty prompt starts from BOS, the same fallback model.generate uses
+    prompt_ids = [ids or [fallback] for ids in tokenizer(prompts)["input_ids"]]
+    TOKENIZATION_SECONDS.labels(model=served.name, streaming=_streaming_label(stream)).observe(
+        time.perf_counter() - tokenize_start)
+    return prompt_ids
+
+async def run_inference(served: "ServedModel", request: InferenceRequest, prompt_ids: Optional[List[int]] = None,
+                        queued_at: Optional[float] = None):
+    start_time = time.time()
+    if prompt_ids is None:
+        prompt_ids = _tokenize_prompts(served, [request.prompt])[0]
+    return await _complete(served, request, prompt_ids, start_time, queued_at)
+
+async def _complete(served: "ServedModel", request: InferenceRequest, prompt_ids: List[int], start_time: float,
+                    queued_at: Optional[float] = None) -> InferenceResponse:
+    """Generate the response for one tokenized request; callers already missed in the response cache."""
+    prompt_tokens = len(prompt_ids)
+
+    # max_length counts the prompt, like model.generate; at least one new token is produced
+    max_new_tokens = max(min(request.max_length, 100) - prompt_tokens, 1)  # Reduced for speed
+
+    # Generate text with timing
+    with PROCESSING_TIME.labels(model=served.name).time():
+        sequences = await served.engine.generate(prompt_ids, request, max_new_tokens, queued_at)
+
+    # Decode generated text (the prompt is not part of the engine output)
+    detokenize_start = time.perf_counter()
+    output_texts = [served.tokenizer.decode(output_ids, skip_special_tokens=True) for output_ids in sequences]
+    DETOKENIZATION_SECONDS.labels(model=served.name, streaming="false").observe(time.perf_counter() - detokenize_start)
+
+    # Calculate token usage
+    completion_tokens = sum(len(output_ids) for output_ids in sequences)
+    total_tokens = prompt_tokens + completion_tokens
+
+    # Update metrics
+    REQUESTS.labels(model=served.name).inc()
+    TOKENS_PROCESSED.labels(type="prompt", model=served.name).inc(prompt_tokens)
+    TOKENS_PROCESSED.labels(type="completion", model=served.name).inc(completion_tokens)
+
+    # Calculate processing time
+    processing_time = time.time() - start_time
+    logger.info(f"Inference completed in {processing_time:.2f}s | Tokens: {total_tokens}")
+
+    response = InferenceResponse(
+        output_text=output_texts[0],
+        token_usage=TokenCount(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens
+        ),
+        model=served.name,
+        processing_time=processing_time,
+        output_texts=output_texts if len(output_texts) > 1 else None
+    )
+    if response_cache is not None and _is_cacheable(request):
+        await response_cache.put(response_cache.key(request), response)
+    return response
+
+def _tokenize_batch(served_models: List[Optional["ServedModel"]], prompts: List[str]) -> List[Optional[List[int]]]:
+    """Tokenize a batch whose prompts may target different models, one call per model; None models are skipped."""
+    prompt_ids: List[Optional[List[int]]] = [None] * len(prompts)
+    groups: Dict[str, List[int]] = {}
+    for i, served in enumerate(served_models):
+        if served is not None:
+            groups.setdefault(served.name, []).append(i)
+    for indices in groups.values():
+        group_ids = _tokenize_prompts(served_models[indices[0]], [prompts[i] for i in indices])
+        for i, ids in zip(indices, group_ids):
+            prompt_ids[i] = ids
+    return prompt_ids
+
+async def run_batch_inference(served_models: List[Optional["ServedModel"]], batch: BatchInferenceRequest,
+                              prompt_ids: Optional[List[Optional[List[int]]]] = None,
+                              queued_at: Optional[float] = None,
+                              cached: Optional[List[Optional[InferenceResponse]]] = None) -> BatchInferenceResponse:
+    """Run every prompt of a batch; served_models holds the model of each item, None for items in cached."""
+    start_time = time.time()
+    requests = batch.requests
+    cached = cached or [None] * len(requests)
+    if prompt_ids is None:
+        prompt_ids = _tokenize_batch(served_models, [item.prompt for item in requests])
+
+    # Submit shortest prompts first so the engine fills each batch with similar lengths
+    order = sorted((i for i in range(len(requests)) if cached[i] is None), key=lambda i: len(prompt_ids[i]))
+    tasks = {i: asyncio.ensure_future(_complete(served_models[i], requests[i], prompt_ids[i], start_time, queued_at))
+             for i in order}
+    try:
+        if tasks:
+            await asyncio.wait(tasks.values())
+    except asyncio.CancelledError:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    results = []
+    usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for i in range(len(requests)):
+        result = cached[i]
+        if result is None:
+            error = tasks[i].exception()
+            if error is not None:
+                logger.error(f"Batch item {i} failed: {error}")
+                results.append(BatchInferenceItem(index=i, error=str(error)))
+                continue
+            result = tasks[i].result()
+        for key in usage:
+            usage[key] += getattr(result.token_usage, key)
+        results.append(BatchInferenceItem(index=i, result=result))
+
+    processing_time = time.time() - start_time
+    logger.info(f"Batch inference of {len(requests)} prompts completed in {processing_time:.2f}s | Tokens: {usage['total_tokens']}")
+    return BatchInferenceResponse(
+        results=results,
+        token_usage=TokenCount(**usage),
+        # Comma-separated when the items named different models
+        model=",".join(dict.fromkeys(served.name if served is not None else cached[i].model
+                                     for i, served in enumerate(served_models))),
+        processing_time=processing_time
+    )
+
+# Streaming Decode Buffers
+# The streaming path writes token ids, the attention mask and (for models that
+# support it) the KV cache into buffers preallocated for the whole sequence,
+# instead of growing them with torch.cat on every token. Buffers are pooled
+# per capacity bucket and reused across requests.
+class _StreamBuffers:
+    """Preallocated decode state for one stream, sized to prompt + max new tokens."""
+
+    def __init__(self, model, capacity: int):
+        self.capacity = capacity
+        self.input_ids = torch.zeros((1, capacity), dtype=torch.long, device=model.device)
+        # A single stream is never padded, so the mask is all ones and only sliced
+        self.attention_mask = torch.ones((1, capacity), dtype=torch.long, device=model.device)
+        self.length = 0
+
+        # Models that go through the Cache API can write keys/values in place;
+        # others (e.g. GPT-2) concatenate internally and keep a dynamic cache
+        self.static_cache = None
+        if getattr(model, "_supports_static_cache", False):
+            self.static_cache = StaticCache(
+                config=model.config,
+                max_batch_size=1,
+                max_cache_len=capacity,
+                device=model.device,
+                dtype=model.dtype,
+            )
+
+    def load_prompt(self, prompt_ids: torch.Tensor):
+        prompt_length = prompt_ids.shape[-1]
+        self.input_ids[:, :prompt_length] = prompt_ids
+        self.length = prompt_length
+        if self.static_cache is not None:
+            self.static_cache.reset()
+
+    def append(self, token_id: torch.Tensor):
+        self.input_ids[:, self.length] = token_id
+        self.length += 1
+
+class StreamBufferPool:
+    """Pool of _StreamBuffers keyed by capacity, rounded up to STREAM_BUFFER_BLOCK tokens."""
+
+    def __init__(self, model, max_free_per_capacity: int = STREAM_BUFFER_POOL_SIZE):
+        self.model = model
+        self.max_free_per_capacity = max_free_per_capacity
+        self._free: Dict[int, List[_StreamBuffers]] = {}
+
+    def acquire(self, length: int) -> _StreamBuffers:
+        capacity = -(-length // STREAM_BUFFER_BLOCK) * STREAM_BUFFER_BLOCK
+        free = self._free.get(capacity)
+        if free:
+            return free.pop()
+        return _StreamBuffers(self.model, capacity)
+
+    def release(self, buffers: _StreamBuffers):
+        free = self._free.setdefault(buffers.capacity, [])
+        if len(free) < self.max_free_per_capacity:
+            free.append(buffers)
+
+# Model Registry
+# Besides MODEL_NAME, requests may name any model in SERVED_MODELS. Those are
+# loaded on first use, off the event loop, with concurrent requests for the
+# same model waiting on a single load. Models whose tokenizers are identical
+# share one tokenizer. Each loaded model has its own batching engine and
+# stream buffers, while all of them share the inference executor. Once the
+# loaded weights exceed MODEL_MEMORY_BUDGET_MB, the least recently used models
+# that no request holds are evicted; MODEL_NAME always stays loaded.
+class UnknownModel(Exception):
+    """Raised for a model this service is not configured to serve."""
+
+class ServedModel:
+    """A loaded model with its tokenizer, batching engine and streaming buffers."""
+
+    def __init__(self, name: str, tokenizer, model, quantization: str, draft_model=None):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        # decode_model is model, or its compiled version
+        self.decode_model = model
+        self.draft_model = draft_model
+        self.quantization = quantization
+        self.memory_bytes = _model_memory_bytes(model)
+        if draft_model is not None:
+            self.memory_bytes += _model_memory_bytes(draft_model)
+        self.kv_pool = KVBlockPool(model, name, kv_budget) if kv_budget is not None else None
+        if self.kv_pool is not None:
+            logger.info(f"KV cache for {name}: up to {self.kv_pool.num_blocks} pages of {self.kv_pool.block_tokens} "
+                        f"tokens in the shared {kv_budget.max_bytes / 1024 ** 2:.1f} MB")
+        self.engine = BatchingEngine(
+            model, tokenizer, name, inference_executor,
+            prefix_cache=PrefixCache(name) if PREFIX_CACHE_ENABLED else None,
+            draft_model=draft_model,
+            kv_pool=self.kv_pool
+        )
+        self.stream_buffer_pool = StreamBufferPool(model)
+        # Requests currently holding a _ModelLease on this model
+        self.active = 0
+        # Responses currently streaming from this model
+        self.active_streams = 0
+
+    def set_decode_model(self, decode_model):
+        self.decode_model = self.engine.decode_model = decode_model
+
+class _ModelLease:
+    """Keeps a served model from being evicted while a request uses it; released exactly once."""
+
+    def __init__(self, served: ServedModel):
+        self.served = served
+        self._released = False
+        served.active += 1
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.served.active -= 1
+
+    def __del__(self):
+        # Every path releases explicitly; releasing here could run on any thread
+        if not self._released:
+            logger.warning(f"Lease on model {self.served.name} was never released")
+
+class ModelRegistry:
+    """Loaded models in least recently used order, loading and evicting them on demand."""
+
+    def __init__(self, default_name: str = MODEL_NAME, served_names: List[str] = SERVED_MODELS,
+                 memory_budget: int = int(MODEL_MEMORY_BUDGET_MB * 1024 ** 2)):
+        self.default_name = default_name
+        self.served_names = {default_name, *served_names}
+        self.memory_budget = memory_budget
+        self._models: "OrderedDict[str, ServedModel]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        # Requests waiting on a load, per model; such models are never evicted before they are leased
+        self._waiters: Dict[str, int] = {}
+
+    @property
+    def default(self) -> Optional[ServedModel]:
+        return self._models.get(self.default_name)
+
+    @property
+    def loaded(self) -> List[str]:
+        return list(self._models)
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(served.memory_bytes for served in self._models.values())
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(served.engine.queue_depth for served in self._models.values())
+
+    @property
+    def batch_size(self) -> int:
+        return sum(served.engine.batch_size for served in self._models.values())
+
+    async def add(self, served: ServedModel):
+        """Start serving a loaded model, evicting idle ones if it takes us over budget."""
+        served.engine.start()
+        self._models[served.name] = served
+        await self._evict(keep=served.name)
+
+    async def acquire(self, name: Optional[str] = None) -> _ModelLease:
+        """Lease a model by name (MODEL_NAME when None), loading it first if needed."""
+        name = name or self.default_name
+        served = self._models.get(name)
+        if served is None:
+            if name not in self.served_names:
+                raise UnknownModel(f"Model {name} is not served here")
+            self._waiters[name] = self._waiters.get(name, 0) + 1
+            try:
+                served = await self._load(name)
+            finally:
+                self._waiters[name] -= 1
+                if not self._waiters[name]:
+                    del self._waiters[name]
+        # No await from here on: the lease is taken before any other eviction can run
+        self._models.move_to_end(name)
+        return _ModelLease(served)
+
+    async def _load(self, name: str) -> ServedModel:
+        loading = self._loading.get(name)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load_and_add(name))
+            self._loading[name] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(name, None))
+        # A cancelled request does not cancel the load other requests wait on
+        return await asyncio.shield(loading)
+
+    async def _load_and_add(self, name: str) -> ServedModel:
+        logger.info(f"Loading model {name} on demand")
+        served = await asyncio.get_running_loop().run_in_executor(None, load_model, name)
+        await self.add(served)
+        return served
+
+    async def _evict(self, keep: str):
+        evicted = False
+        while self.memory_budget and self.memory_bytes > self.memory_budget:
+            victim = next((served for served in self._models.values()
+                           if served.name not in (self.default_name, keep) and served.active == 0
+                           and served.name not in self._waiters), None)
+            if victim is None:
+                logger.warning(f"Loaded models use {self.memory_bytes / 1024 ** 2:.1f} MB, over the "
+                               f"{self.memory_budget / 1024 ** 2:.1f} MB budget, but every other model is in use")
+                break
+            del self._models[victim.name]
+            await victim.engine.stop()
+            MODEL_EVICTIONS.labels(model=victim.name).inc()
+            MODEL_MEMORY.remove(victim.name, victim.quantization)
+            if victim.kv_pool is not None:
+                KV_CACHE_USED_BYTES.remove(victim.name)
+            logger.info(f"Evicted model {victim.name} ({victim.memory_bytes / 1024 ** 2:.1f} MB)")
+            evicted = True
+        MODELS_LOADED.set(len(self._models))
+        if evicted:
+            # Return the weights to the OS (and the GPU allocator) right away
+            gc.collect()
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+model_registry = ModelRegistry()
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token ids into text, decoding only a short window around
+    the newest tokens. Text is released once it is complete, so BPE merges and
+    multi-byte characters split across tokens come out whole.
+    """
+
+    # Trailing prompt tokens kept as context, so leading spaces decode correctly
+    CONTEXT_TOKENS = 5
+
+    def __init__(self, tokenizer, prompt_ids: List[int], skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        # ids[:read_offset] were already released (or are prompt context), ids[read_offset:] not yet
+        self.ids = list(prompt_ids[-self.CONTEXT_TOKENS:])
+        self.read_offset = len(self.ids)
+
+    def _new_text(self) -> str:
+        released = self.tokenizer.decode(self.ids[:self.read_offset], skip_special_tokens=self.skip_special_tokens)
+        text = self.tokenizer.decode(self.ids, skip_special_tokens=self.skip_special_tokens)
+        return text[len(released):] if len(text) > len(released) else ""
+
+    def add(self, token_id: int) -> str:
+        """Add a token and return the text it completes (possibly empty)."""
+        self.ids.append(token_id)
+        text = self._new_text()
+        # A trailing replacement character is an incomplete multi-byte sequence; wait for more
+        if not text or text.endswith("\ufffd"):
+            return ""
+        # The tokens just released are all the context the next decode needs
+        self.ids = self.ids[self.read_offset:]
+        self.read_offset = len(self.ids)
+        return text
+
+    def flush(self) -> str:
+        """Return whatever text is still held back, at the end of the stream."""
+        text = self._new_text()
+        self.ids = self.ids[self.read_offset:]
+        self.read_offset = len(self.ids)
+        return text
+
+@torch.inference_mode()
+def _prefill_stream_chunk(model, buffers, past_key_values, start: int, end: int):
+    """Feed prompt positions [start, end) into the cache without sampling. Blocking - run it on the inference executor."""
+    model_inputs = {
+        "input_ids": buffers.input_ids[:, start:end],
+        "attention_mask": buffers.attention_mask[:, :end],
+    }
+    if buffers.static_cache is not None:
+        model_inputs["past_key_values"] = buffers.static_cache
+        model_inputs["cache_position"] = torch.arange(start, end, device=buffers.input_ids.device)
+    elif past_key_values is not None:
+        model_inputs["past_key_values"] = past_key_values
+    if _supports_logits_to_keep(model):
+        model_inputs["logits_to_keep"] = 1
+    return model(**model_inputs, use_cache=True).past_key_values
+
+@torch.inference_mode()
+def _generate_next_token(model, buffers, past_key_values, params, generator=None):
+    """Helper function to generate the next token. Blocking - run it on the inference executor."""
+    # Prefill feeds the whole prompt, decode steps only the latest token
+    start = buffers.length - 1 if past_key_values is not None else 0
+    model_inputs = {
+        "input_ids": buffers.input_ids[:, start:buffers.length],
+        "attention_mask": buffers.attention_mask[:, :buffers.length],
+    }
+    
+    if buffers.static_cache is not None:
+        # Keys/values are written in place at these positions of the preallocated cache
+        model_inputs["past_key_values"] = buffers.static_cache
+        model_inputs["cache_position"] = torch.arange(start, buffers.length, device=buffers.input_ids.device)
+    elif past_key_values is not None:
+        model_inputs["past_key_values"] = past_key_values
+    
+    # Generate next token logits
+    outputs = model(**model_inputs, use_cache=True)
+    past_key_values = outputs.past_key_values
+    
+    # Same sampler as the batching engine, so streamed and non-streamed outputs agree
+    history = buffers.input_ids[:, :buffers.length] if params.any_penalty else None
+    scores = process_logits(outputs.logits[:, -1, :], history, params)
+    next_token, _ = sample_tokens(scores, params, [generator])
+    
+    # Record the token in place - no per-token reallocation of ids or mask
+    buffers.append(next_token)
+    
+    return next_token, past_key_values
+
+@torch.inference_mode()
+def _generate_speculative_tokens(model, draft_model, buffers, past_key_values, draft, request, params,
+                                 generator=None, max_tokens=SPECULATIVE_TOKENS + 1):
+    """
+    Decode step with a draft model: propose up to SPECULATIVE_TOKENS tokens, verify
+    them in one forward pass of the main model. Returns the accepted token ids plus
+    the main model's own next token. Blocking - run it on the inference executor.
+    """
+    # The last sampled token is not in the main model's cache yet
+    start = buffers.length - 1
+    context_ids = buffers.input_ids[0, :buffers.length].tolist()
+    draft_ids, draft_probs = [], []
+    for _ in range(min(SPECULATIVE_TOKENS, max_tokens - 1)):
+        logits = _ragged_forward(draft_model, [draft])
+        # Penalties see the tokens drafted so far this round, as in the engine's _propose
+        history = None
+        if params.any_penalty:
+            history = _pad_context([context_ids + draft_ids], logits.device)
+        token, probs = sample_tokens(process_logits(logits[:, -1], history, params), params, [generator])
+        draft_ids.append(int(token))
+        draft_probs.append(probs[0] if probs is not None else None)
+        draft.pending_ids = [int(token)]
+    for token_id in draft_ids:
+        buffers.append(token_id)
+
+    model_inputs = {
+        "input_ids": buffers.input_ids[:, start:buffers.length],
+        "attention_mask": buffers.attention_mask[:, :buffers.length],
+    }
+    if buffers.static_cache is not None:
+        model_inputs["past_key_values"] = buffers.static_cache
+        model_inputs["cache_position"] = torch.arange(start, buffers.length, device=buffers.input_ids.device)
+    else:
+        model_inputs["past_key_values"] = past_key_values
+    if _supports_logits_to_keep(model):
+        model_inputs["logits_to_keep"] = len(draft_ids) + 1
+    outputs = model(**model_inputs, use_cache=True)
+
+    accepted, token_id = _verify_draft(
+        outputs.logits[0, -(len(draft_ids) + 1):], draft_ids, draft_probs, context_ids, request, generator
+    )
+
+    # Rewind past the rejected drafts; a static cache is simply overwritten from there
+    buffers.length = start + 1 + accepted
+    buffers.append(token_id)
+    past_key_values = outputs.past_key_values
+    if buffers.static_cache is None:
+        past_key_values = _crop_cache(past_key_values, start + 1 + accepted)
+    _rewind_draft(draft, draft_ids, accepted, token_id)
+    _record_speculation(MODEL_NAME, len(draft_ids), accepted)
+    return draft_ids[:accepted] + [token_id], past_key_values
+
+class _ReleasingStreamingResponse(StreamingResponse):
+    """
+    Releases what a streamed request holds once the response is over - also
+    when the client goes away before the body generator ever starts, in which
+    case the generator's own cleanup never runs.
+    """
+
+    def __init__(self, content, held: list, **kwargs):
+        super().__init__(content, **kwargs)
+        self.held = held
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for resource in reversed(self.held):
+                resource.release()
+
+async def stream_inference(lease: _ModelLease, request: InferenceRequest, slot: _ExecutorSlot,
+                           ticket: _AdmissionTicket, prompt_ids: List[int],
+                           queued_at: float) -> AsyncGenerator[str, None]:
+    try:
+        async for chunk in _stream_tokens(lease.served, request, prompt_ids, queued_at):
+            yield chunk
+    finally:
+        # Runs on completion and when the client disconnects mid-stream
+        slot.release()
+        ticket.release()
+        lease.release()
+
+async def _stream_tokens(served: ServedModel, request: InferenceRequest, prompt_ids: Optional[List[int]] = None,
+                         queued_at: Optional[float] = None) -> AsyncGenerator[str, None]:
+    start_time = time.time()
+    model, decode_model, draft_model, tokenizer = served.model, served.decode_model, served.draft_model, served.tokenizer
+    queued_at = queued_at if queued_at is not None else start_time
+    
+    # Tokenize input (admission control has usually tokenized it already)
+    if prompt_ids is None:
+        prompt_ids = _tokenize_prompts(served, [request.prompt], stream=True)[0]
+    input_ids = torch.tensor([prompt_ids], device=device)
+    prompt_tokens = len(prompt_ids)
+    
+    # Initialize generation state in pooled, preallocated buffers
+    past_key_values = None
+    completion_tokens = 0
+    max_length = min(request.max_length + prompt_tokens, prompt_tokens + 100)
+    buffers = served.stream_buffer_pool.acquire(max_length)
+    buffers.load_prompt(input_ids)
+    step_in_flight = False
+    generator = torch.Generator(device=device).manual_seed(request.seed) if request.seed is not None else None
+    
+    # With a draft model every decode step may yield several tokens
+    draft = _KVState(prompt_ids) if draft_model is not None else None
+    params = SamplingParams([request], device)
+    detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+    max_new_tokens = max_length - prompt_tokens
+    is_finished = False
+    
+    # Text is coalesced into chunks, flushed every STREAM_FLUSH_INTERVAL_MS or STREAM_FLUSH_BYTES
+    pending_text = ""
+    last_flush = time.monotonic()
+    
+    # Stage timings; time spent suspended in yield is the client reading, not processing
+    detokenize_seconds = serialize_seconds = client_seconds = 0.0
+    INFLIGHT_SEQUENCES.labels(model=served.name, streaming="true").inc()
+    served.active_streams += 1
+    
+    # Generate tokens one step at a time to enable streaming
+    try:
+        while not is_finished:
+            # Generate next tokens on the inference executor, off the event loop
+            step_in_flight = True
+            step_start = time.time()
+            # Every stream decodes its own sequence, one per step
+            BATCH_SIZE.labels(model=served.name, streaming="true").set(1)
+            if past_key_values is None:
+                QUEUE_WAIT_SECONDS.labels(model=served.name, streaming="true").observe(max(0.0, step_start - queued_at))
+                # A long prompt is prefilled one chunk per executor job, letting other
+                # streams and engine steps run in between; the last token samples below
+                if PREFILL_CHUNK_TOKENS and prompt_tokens > PREFILL_CHUNK_TOKENS:
+                    for chunk_start in range(0, prompt_tokens - 1, PREFILL_CHUNK_TOKENS):
+                        past_key_values = await inference_executor.run(
+                            _prefill_stream_chunk, model, buffers, past_key_values,
+                            chunk_start, min(chunk_start + PREFILL_CHUNK_TOKENS, prompt_tokens - 1)
+                        )
+            remaining = max_new_tokens - completion_tokens
+            if draft is not None and past_key_values is not None and remaining > 1:
+                new_tokens, past_key_values = await inference_executor.run(
+                    _generate_speculative_tokens, model, draft_model, buffers, past_key_values, draft,
+                    request, params, generator, remaining
+                )
+            else:
+                next_token, past_key_values = await inference_executor.run(
+                    _generate_next_token,
+                    decode_model if past_key_values is not None else model,
+                    buffers, past_key_values, params, generator
+                )
+                new_tokens = [next_token.item()]
+                if draft is not None:
+                    draft.pending_ids.extend(new_tokens)
+            step_in_flight = False
+            now = time.time()
+            if completion_tokens == 0:
+                TIME_TO_FIRST_TOKEN.labels(model=served.name, streaming="true").observe(now - queued_at)
+            else:
+                DECODE_TOKEN_SECONDS.labels(model=served.name, streaming="true").observe((now - step_start) / len(new_tokens))
+            
+            detokenize_start = time.perf_counter()
+            for token_id in new_tokens:
+                completion_tokens += 1
+                pending_text += detokenizer.add(token_id)
+                # Check if generation should stop
+                is_finished = token_id == tokenizer.eos_token_id or completion_tokens >= max_new_tokens
+                if is_finished:
+                    break
+            detokenize_seconds += time.perf_counter() - detokenize_start
+            
+            if not is_finished:
+                now = time.monotonic()
+                if pending_text and (len(pending_text.encode()) >= STREAM_FLUSH_BYTES
+                                     or now - last_flush >= STREAM_FLUSH_INTERVAL_MS / 1000):
+                    serialize_start = time.perf_counter()
+                    line = json.dumps({"token": pending_text, "is_finished": False}) + "\n"
+                    yield_start = time.perf_counter()
+                    serialize_seconds += yield_start - serialize_start
+                    yield line
+                    client_seconds += time.perf_counter() - yield_start
+                    pending_text = ""
+                    last_flush = now
+                continue
+            
+            # The final chunk is always sent, with any text still held back
+            total_tokens = prompt_tokens + completion_tokens
+            processing_time = time.time() - start_time
+            
+            # Update metrics
+            REQUESTS.labels(model=served.name).inc()
+            TOKENS_PROCESSED.labels(type="prompt", model=served.name).inc(prompt_tokens)
+            TOKENS_PROCESSED.labels(type="completion", model=served.name).inc(completion_tokens)
+            
+            detokenize_start = time.perf_counter()
+            pending_text += detokenizer.flush()
+            detokenize_seconds += time.perf_counter() - detokenize_start
+            chunk = {
+                "token": pending_text,
+                "is_finished": True,
+                "token_count": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": total_tokens
+                },
+                "model": served.name,
+                "processing_time": processing_time
+            }
+            
+            logger.info(f"Streaming inference completed in {processing_time:.2f}s | Tokens: {total_tokens}")
+            serialize_start = time.perf_counter()
+            line = json.dumps(chunk) + "\n"
+            yield_start = time.perf_counter()
+            serialize_seconds += yield_start - serialize_start
+            yield line
+            client_seconds += time.perf_counter() - yield_start
+    finally:
+        # A step cancelled by a disconnect may still be writing into the buffers
+        # on the executor thread; those buffers are dropped instead of reused
+        if not step_in_flight:
+            served.stream_buffer_pool.release(buffers)
+        INFLIGHT_SEQUENCES.labels(model=served.name, streaming="true").dec()
+        served.active_streams -= 1
+        if not served.active_streams:
+            BATCH_SIZE.labels(model=served.name, streaming="true").set(0)
+        PROCESSING_TIME.labels(model=served.name).observe(time.time() - start_time - client_seconds)
+        DETOKENIZATION_SECONDS.labels(model=served.name, streaming="true").observe(detokenize_seconds)
+        SERIALIZATION_SECONDS.labels(model=served.name, streaming="true").observe(serialize_seconds)
+
+async def _wait_for_disconnect(http_request: Request):
+    """Return once the client behind http_request has gone away (ASGI http.disconnect)."""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def _run_until_disconnect(coro, http_request: Request):
+    """
+    Await coro, cancelling it if the client disconnects first.
+    Returns (finished, result) so callers can tell a cancelled run apart.
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        return False, None
+    return True, task.result()
+
+async def _admit(user_id: Optional[str], cost: int, stream: bool = False) -> _AdmissionTicket:
+    """Admit a request against the token budget, answering 429 when it is shed."""
+    controller = stream_admission if stream else admission
+    try:
+        return await controller.admit(user_id or DEFAULT_USER_ID, cost)
+    except AdmissionRejected as e:
+        logger.warning(f"Shedding request ({e.reason}): {e}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too much work queued, retry later",
+            headers={"Retry-After": RETRY_AFTER_SECONDS}
+        )
+
+async def _acquire_model(name: Optional[str]) -> _ModelLease:
+    """Lease the requested model, answering 404 for models not served here and 503 when loading fails."""
+    try:
+        return await model_registry.acquire(name)
+    except UnknownModel as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error loading model {name}: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model {name} could not be loaded",
+            headers={"Retry-After": RETRY_AFTER_SECONDS}
+        )
+
+def _json_response(body: BaseModel, model_name: str) -> Response:
+    """Serialize a response model here rather than in FastAPI, so the time is measured."""
+    serialize_start = time.perf_counter()
+    content = body.model_dump_json()
+    SERIALIZATION_SECONDS.labels(model=model_name, streaming="false").observe(time.perf_counter() - serialize_start)
+    return Response(content=content, media_type="application/json")
+
+@app.post("/inference")
+async def inference(request: InferenceRequest, http_request: Request):
+    start_time = time.time()
+    logger.info(f"Received inference request: {request.prompt[:50]}...")
+
+    if not model_ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is not ready",
+            headers={"Retry-After": RETRY_AFTER_SECONDS}
+        )
+
+    # Repeated reproducible requests are answered before taking a model, token budget or slot
+    if not request.stream:
+        cached_response = await _cached_response(request, start_time)
+        if cached_response is not None:
+            return _json_response(cached_response, cached_response.model)
+
+    # The model is held until the response is done, so it cannot be evicted mid-request
+    lease = await _acquire_model(request.model)
+    served = lease.served
+    # Lease, ticket and slot as they are taken; released on every path, or handed to the streaming response
+    held: list = [lease]
+    try:
+        # Wait for token budget, or shed the request early when the backlog is too deep
+        prompt_ids = _tokenize_prompts(served, [request.prompt], request.stream)[0]
+        queued_at = time.time()
+        held.append(await _admit(request.user_id, _request_cost(request, len(prompt_ids), served), request.stream))
+        ticket = held[-1]
+
+        # Backpressure: reject early rather than queueing behind a saturated model
+        try:
+            held.append(inference_executor.reserve())
+        except ExecutorSaturated as e:
+            logger.warning(f"Rejecting inference request, executor saturated: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Inference queue is full, retry later",
+                headers={"Retry-After": RETRY_AFTER_SECONDS}
+            )
+        slot = held[-1]
+
+        # Check if streaming is requested
+        if request.stream:
+            logger.info("Streaming response requested")
+            # Return a streaming response; it releases the slot, ticket and lease once it is over
+            response = _ReleasingStreamingResponse(
+                stream_inference(lease, request, slot, ticket, prompt_ids, queued_at), held,
+                media_type="application/x-ndjson"
+            )
+            held = []
+            return response
+
+        # Return a regular response, dropping the work if the client goes away
+        finished, response = await _run_until_disconnect(
+            run_inference(served, request, prompt_ids, queued_at), http_request
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for resource in reversed(held):
+            resource.release()
+    if not finished:
+        logger.info(f"Client disconnected, cancelled inference after {time.time() - start_time:.2f}s")
+        return Response(status_code=499)
+    return _json_response(response, served.name)
+
+@app.post("/inference/batch", response_model=BatchInferenceResponse)
+async def batch_inference(batch: BatchInferenceRequest, http_request: Request):
+    start_time = time.time()
+    logger.info(f"Received batch inference request with {len(batch.requests)} prompts")
+
+    if not model_ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is not ready",
+            headers={"Retry-After": RETRY_AFTER_SECONDS}
+        )
+
+    # Items answered by the response cache take no model, token budget or slot
+    cached = [await _cached_response(item, start_time) for item in batch.requests]
+    pending = [item for item, cached_response in zip(batch.requests, cached) if cached_response is None]
+    if not pending:
+        response = await run_batch_inference([None] * len(cached), batch, cached=cached)
+        return _json_response(response, response.model)
+
+    # One lease per distinct model named in the batch, then the ticket and slot; all released on every path
+    leases: Dict[Optional[str], _ModelLease] = {}
+    held: list = []
+    try:
+        for item in pending:
+            if item.model not in leases:
+                leases[item.model] = await _acquire_model(item.model)
+                held.append(leases[item.model])
+        served_models = [leases[item.model].served if cached_response is None else None
+                         for item, cached_response in zip(batch.requests, cached)]
+
+        # The batch is admitted as one unit costing all of its uncached prompts
+        prompt_ids = _tokenize_batch(served_models, [item.prompt for item in batch.requests])
+        queued_at = time.time()
+        held.append(await _admit(pending[0].user_id, sum(
+            _request_cost(item, len(ids), served_model)
+            for item, ids, served_model in zip(batch.requests, prompt_ids, served_models) if ids is not None
+        )))
+
+        # Every uncached prompt in the batch takes its own admission slot
+        try:
+            held.append(inference_executor.reserve(len(pending)))
+        except ExecutorSaturated as e:
+            logger.warning(f"Rejecting batch inference request, executor saturated: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Inference queue is full, retry later",
+                headers={"Retry-After": RETRY_AFTER_SECONDS}
+            )
+
+        try:
+            finished, response = await _run_until_disconnect(
+                run_batch_inference(served_models, batch, prompt_ids, queued_at, cached), http_request
+            )
+        except Exception as e:
+            logger.error(f"Error processing batch request: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for resource in reversed(held):
+            resource.release()
+    if not finished:
+        logger.info(f"Client disconnected, cancelled batch inference after {time.time() - start_time:.2f}s")
+        return Response(status_code=499)
+    return _json_response(response, response.model)
+
+# AMQP Consumer
+# In worker mode the service reads inference_requests straight from RabbitMQ
+# instead of through the Bento ml-worker and its HTTP hop. Up to AMQP_PREFETCH
+# messages are unacked at once so the broker keeps the batching engine fed;
+# each result is published to inference_results in the ml-worker's message
+# schema, and the request is acked only after the broker confirmed the result.
+class InMemoryMessage:
+    """Queued message exposing the parts of an aio-pika IncomingMessage the consumer uses."""
+
+    def __init__(self, queue: str, body: bytes, message_id: Optional[str] = None,
+                 user_id: Optional[str] = None, headers: Optional[dict] = None, type: Optional[str] = None):
+        self.queue = queue
+        self.body = body
+        self.message_id = message_id
+        self.user_id = user_id
+        self.headers = headers or {}
+        self.type = type
+        self.redelivered = False
+        self._broker: Optional["InMemoryBroker"] = None
+
+    async def ack(self):
+        self._broker._settle(self, requeue=False)
+
+    async def nack(self, requeue: bool = True):
+        self._broker._settle(self, requeue=requeue)
+
+class InMemoryBroker:
+    """In-process stand-in for RabbitMQ: named queues, prefetch-limited delivery, ack and nack."""
+
+    def __init__(self):
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self._prefetch = 1
+        self._unacked: set = set()
+        self._settled = asyncio.Event()
+        self._consumer: Optional[asyncio.Task] = None
+
+    def queue(self, name: str) -> asyncio.Queue:
+        if name not in self.queues:
+            self.queues[name] = asyncio.Queue()
+        return self.queues[name]
+
+    async def connect(self, prefetch: int):
+        self._prefetch = max(1, prefetch)
+
+    async def publish(self, queue: str, body: bytes, message_id: Optional[str] = None,
+                      headers: Optional[dict] = None, type: Optional[str] = None):
+        self.queue(queue).put_nowait(InMemoryMessage(queue, body, message_id=message_id, headers=headers, type=type))
+
+    async def consume(self, queue: str, callback):
+        self._consumer = asyncio.ensure_future(self._deliver(queue, callback))
+
+    async def _deliver(self, queue: str, callback):
+        pending = self.queue(queue)
+        while True:
+            while len(self._unacked) >= self._prefetch:
+                self._settled.clear()
+                await self._settled.wait()
+            message = await pending.get()
+            message._broker = self
+            self._unacked.add(message)
+            await callback(message)
+
+    def _settle(self, message: InMemoryMessage, requeue: bool):
+        if message not in self._unacked:
+            raise RuntimeError("Message was already acked or nacked")
+        self._unacked.discard(message)
+        self._settled.set()
+        if requeue:
+            message.redelivered = True
+            self.queue(message.queue).put_nowait(message)
+
+    async def close(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+        # Like a closed channel, unacked messages go back to their queue
+        for message in list(self._unacked):
+            self._settle(message, requeue=True)
+
+class AmqpBroker:
+    """RabbitMQ connection through aio-pika, with publisher confirms."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._connection = None
+        self._channel = None
+
+    async def connect(self, prefetch: int):
+        import aio_pika
+        # A robust connection reconnects and restores the consumer after broker restarts
+        self._connection = await aio_pika.connect_robust(self.url)
+        self._channel = await self._connection.channel(publisher_confirms=True)
+        await self._channel.set_qos(prefetch_count=max(1, prefetch))
+
+    async def publish(self, queue: str, body: bytes, message_id: Optional[str] = None,
+                      headers: Optional[dict] = None, type: Optional[str] = None):
+        import aio_pika
+        message = aio_pika.Message(
+            body,
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            message_id=message_id,
+            headers=headers,
+            type=type,
+        )
+        # Returns once the broker confirmed the message (raises if it was rejected or unroutable)
+        await self._channel.default_exchange.publish(message, routing_key=queue)
+
+    async def consume(self, queue: str, callback):
+        amqp_queue = await self._channel.declare_queue(queue, durable=True)
+        await amqp_queue.consume(callback)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = self._channel = None
+
+class InferenceConsumer:
+    """Runs inference for every message on the request queue and publishes the result."""
+
+    # Error output the ml-worker publishes when the service fails
+    ERROR_OUTPUT = json.dumps({"error": "Service unavailable", "output_text": "Error processing request"})
+
+    def __init__(self, broker, request_queue: str = AMQP_REQUEST_QUEUE,
+                 result_queue: str = AMQP_RESULT_QUEUE, prefetch: int = AMQP_PREFETCH):
+        self.broker = broker
+        self.request_queue = request_queue
+        self.result_queue = result_queue
+        self.prefetch = max(1, prefetch)
+        self._tasks: set = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def start(self):
+        await self.broker.connect(self.prefetch)
+        await self.broker.consume(self.request_queue, self._on_message)
+        logger.info(f"Consuming {self.request_queue} (prefetch {self.prefetch}), publishing to {self.result_queue}")
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        # Unacked messages are redelivered to another consumer
+        await self.broker.close()
+
+    async def _on_message(self, message):
+        # Handle messages concurrently so the engine batches them together
+        task = asyncio.ensure_future(self._handle(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, message):
+        raw = message.body.decode("utf-8", errors="replace")
+        try:
+            payload = json.loads(raw)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            payload = {}
+        # Same fallbacks as the ml-worker mapping
+        request_id = str(payload.get("request_id") or message.message_id or uuid.uuid4())
+        user_id = str(payload.get("user_id") or message.user_id or DEFAULT_USER_ID)
+
+        error = None
+        try:
+            request = InferenceRequest.model_validate(payload).model_copy(update={"stream": False, "user_id": user_id})
+            response = await self._infer(request)
+            serialize_start = time.perf_counter()
+            output = response.model_dump_json()
+            SERIALIZATION_SECONDS.labels(model=response.model, streaming="false").observe(time.perf_counter() - serialize_start)
+        except Exception as e:
+            logger.error(f"AMQP request {request_id} failed: {e}")
+            error = str(e)
+            output = self.ERROR_OUTPUT
+
+        result = {
+            "request_id": request_id,
+            "user_id": user_id,
+            "input": raw,
+            "output": output,
+            "timestamp": str(int(time.time())),
+            "has_error": "true" if error else "false",
+            "error_message": (error or "").replace("\n", " ")
+        }
+        try:
+            await self.broker.publish(
+                self.result_queue, json.dumps(result).encode(), message_id=request_id,
+                headers={"routing-key": self.result_queue}, type="inference_result"
+            )
+        except Exception as e:
+            logger.error(f"Publishing result for {request_id} failed, requeueing the request: {e}")
+            AMQP_MESSAGES.labels(outcome="requeued").inc()
+            await message.nack(requeue=True)
+            return
+
+        await message.ack()
+        AMQP_MESSAGES.labels(outcome="failed" if error else "completed").inc()
+
+    async def _infer(self, request: InferenceRequest) -> InferenceResponse:
+        # HTTP requests share the budget and executor; a message that would be shed
+        # waits for room instead of failing - the broker holds the backlog
+        cached_response = await _cached_response(request, time.time())
+        if cached_response is not None:
+            return cached_response
+        lease = await model_registry.acquire(request.model)
+        try:
+            prompt_ids = _tokenize_prompts(lease.served, [request.prompt])[0]
+            cost = _request_cost(request, len(prompt_ids), lease.served)
+            queued_at = time.time()
+            delay = 0.05
+            while True:
+                try:
+                    ticket = await admission.admit(request.user_id, cost)
+                except AdmissionRejected:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, float(RETRY_AFTER_SECONDS))
+                    continue
+                try:
+                    slot = inference_executor.reserve()
+                    break
+                except ExecutorSaturated:
+                    ticket.release()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, float(RETRY_AFTER_SECONDS))
+            try:
+                return await run_inference(lease.served, request, prompt_ids, queued_at)
+            finally:
+                slot.release()
+                ticket.release()
+        finally:
+            lease.release()
+
+def _create_amqp_broker():
+    if AMQP_BROKER == "memory":
+        return InMemoryBroker()
+    if AMQP_BROKER != "amqp":
+        logger.warning(f"Unknown AMQP_BROKER '{AMQP_BROKER}', using amqp")
+    if not RABBITMQ_URL:
+        logger.error("AMQP_CONSUMER_ENABLED needs RABBITMQ_URL, not consuming")
+        return None
+    return AmqpBroker(RABBITMQ_URL)
+
+# Created once the model is ready when AMQP_CONSUMER_ENABLED
+amqp_consumer: Optional[InferenceConsumer] = None
+
+async def start_amqp_consumer():
+    """Connect and start consuming, retrying until the broker is reachable."""
+    global amqp_consumer
+    broker = _create_amqp_broker()
+    if broker is None:
+        return
+    consumer = InferenceConsumer(broker)
+    while True:
+        try:
+            await consumer.start()
+            break
+        except Exception as e:
+            logger.warning(f"Could not start AMQP consumer, retrying: {e}")
+            await asyncio.sleep(5)
+    amqp_consumer = consumer
+
+# Profiling
+# With PROFILING_ENABLED, GET /admin/profile records the live service for a few
+# seconds: torch.profiler on the inference thread (operator time) and a stack
+# sampler over every Python thread, the event loop included. The capture
+# downloads as a Chrome trace (chrome://tracing, Perfetto) or as collapsed
+# stacks for flamegraph tools. It needs PROFILING_TOKEN as well; when disabled,
+# nothing touches the hot path.
+class TorchProfileCapture:
+    """
+    torch.profiler only records the thread that started it, and only one can
+    run at a time, so the first inference thread to run a step during the
+    capture starts it and the same thread stops it.
+    """
+
+    def __init__(self):
+        self.events: List[dict] = []
+        self._owner: Optional[int] = None
+        self._profiler = None
+        self._lock = threading.Lock()
+
+    def attach(self):
+        if self._owner is not None:
+            return
+        with self._lock:
+            if self._owner is not None:
+                return
+            self._owner = threading.get_ident()
+        from torch.profiler import ProfilerActivity, profile
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        self._profiler = profile(activities=activities)
+        self._profiler.__enter__()
+
+    def detach(self):
+        if self._owner != threading.get_ident() or self._profiler is None:
+            return
+        self._profiler.__exit__(None, None, None)
+        with tempfile.TemporaryDirectory() as trace_dir:
+            trace_path = os.path.join(trace_dir, "trace.json")
+            self._profiler.export_chrome_trace(trace_path)
+            with open(trace_path) as trace_file:
+                self.events = json.load(trace_file).get("traceEvents", [])
+        self._profiler = None
+
+class StackSampler:
+    """Samples the Python stack of every thread from a background thread."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # (timestamp in us, thread native id, frames root first)
+        self.samples: List[tuple] = []
+        self.thread_names: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            timestamp = time.time_ns() // 1000
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident == own or thread is None:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.reverse()
+                self.thread_names[thread.native_id] = thread.name
+                self.samples.append((timestamp, thread.native_id, tuple(frames)))
+
+    def collapsed(self) -> Dict[str, int]:
+        """Sample counts per thread;frame;...;frame stack, the flamegraph.pl input format."""
+        counts: Dict[str, int] = {}
+        for _, tid, frames in self.samples:
+            stack = ";".join((self.thread_names[tid],) + frames)
+            counts[stack] = counts.get(stack, 0) + 1
+        return counts
+
+    def trace_events(self) -> List[dict]:
+        """Samples as nested duration events, one track per thread, merging frames that stay on the stack."""
+        pid = os.getpid()
+        events = [{"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in self.thread_names.items()]
+        # tid -> [(frame, start timestamp)] currently open, root first
+        open_frames: Dict[int, List[tuple]] = {}
+        last_seen: Dict[int, int] = {}
+
+        def close(tid: int, depth: int, end: int):
+            stack = open_frames[tid]
+            while len(stack) > depth:
+                name, start = stack.pop()
+                events.append({"ph": "X", "cat": "python", "name": name, "pid": pid, "tid": tid,
+                               "ts": start, "dur": max(1, end - start)})
+
+        for timestamp, tid, frames in self.samples:
+            stack = open_frames.setdefault(tid, [])
+            common = 0
+            while common < len(stack) and common < len(frames) and stack[common][0] == frames[common]:
+                common += 1
+            close(tid, common, timestamp)
+            stack.extend((name, timestamp) for name in frames[common:])
+            last_seen[tid] = timestamp
+        for tid in open_frames:
+            close(tid, 0, last_seen[tid] + int(self.interval * 1e6))
+        return events
+
+def _cap_trace(events: List[dict], max_bytes: int) -> tuple:
+    """Keep the earliest events whose JSON fits in max_bytes; returns (events, truncated)."""
+    metadata = [event for event in events if event.get("ph") == "M"]
+    timed = sorted((event for event in events if event.get("ph") != "M"), key=lambda event: event.get("ts", 0))
+    kept = list(metadata)
+    size = sum(len(json.dumps(event)) + 2 for event in metadata) + 64
+    for event in timed:
+        size += len(json.dumps(event)) + 2
+        if size > max_bytes:
+            return kept, True
+        kept.append(event)
+    return kept, False
+
+def _cap_collapsed(counts: Dict[str, int], max_bytes: int) -> tuple:
+    """Collapsed stack lines, most sampled first, within max_bytes; returns (text, truncated)."""
+    lines, size = [], 0
+    for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+        line = f"{stack} {count}\n"
+        size += len(line.encode())
+        if size > max_bytes:
+            return "".join(lines), True
+        lines.append(line)
+    return "".join(lines), False
+
+_profile_running = False
+
+async def capture_profile(seconds: float, output_format: str) -> tuple:
+    """Record for seconds and return (content, media type, filename)."""
+    sampler = StackSampler(PROFILING_SAMPLE_INTERVAL_MS / 1000)
+    capture = TorchProfileCapture() if output_format == "chrome" else None
+    if capture is not None:
+        inference_executor.start_capture(capture)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+        if capture is not None:
+            await inference_executor.stop_capture()
+
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    if output_format == "collapsed":
+        content, truncated = _cap_collapsed(sampler.collapsed(), PROFILING_MAX_BYTES)
+        logger.info(f"Profile captured: {len(sampler.samples)} stack samples over {seconds:g}s"
+                    f"{' (truncated)' if truncated else ''}")
+        return content, "text/plain", f"profile-{stamp}.collapsed.txt"
+
+    events, truncated = _cap_trace(capture.events + sampler.trace_events(), PROFILING_MAX_BYTES)
+    logger.info(f"Profile captured: {len(capture.events)} operator events, {len(sampler.samples)} stack samples "
+                f"over {seconds:g}s{' (truncated)' if truncated else ''}")
+    trace = {"traceEvents": events, "displayTimeUnit": "ms",
+             "otherData": {"model": MODEL_NAME, "seconds": seconds, "truncated": truncated}}
+    return json.dumps(trace), "application/json", f"profile-{stamp}.trace.json"
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request,
+                        seconds: float = Query(5.0, gt=0, description="Capture length, capped at PROFILING_MAX_SECONDS"),
+                        output_format: str = Query("chrome", alias="format", pattern="^(chrome|collapsed)$",
+                                                   description="chrome: Chrome trace JSON; collapsed: flamegraph stacks")):
+    """Capture a time-boxed profile of the running service and download it."""
+    global _profile_running
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), PROFILING_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if _profile_running:
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+
+    _profile_running = True
+    try:
+        content, media_type, filename = await capture_profile(min(seconds, PROFILING_MAX_SECONDS), output_format)
+    finally:
+        _profile_running = False
+    return Response(content=content, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# Warmup
+# Synthetic prompts across WARMUP_PROMPT_LENGTHS x WARMUP_BATCH_SIZES are run
+# through the batching engine and the streaming path before /ready flips, so
+# kernels, allocator pools, tokenizer caches and (with TORCH_COMPILE) compiled
+# graphs are hot when the first real request arrives.
+def _compile_decode_model(model):
+    """Compile the forward pass used for single-token decode steps."""
+    logger.info(f"Compiling decode step with torch.compile (mode={TORCH_COMPILE_MODE})")
+    return torch.compile(model, mode=TORCH_COMPILE_MODE, dynamic=True)
+
+async def _run_warmup_traffic(served: ServedModel):
+    tokenizer, config = served.tokenizer, served.model.config
+    sample_ids = tokenizer("The quick brown fox jumps over the lazy dog.")["input_ids"] or [tokenizer.eos_token_id]
+    max_positions = getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", 1024)
+    request = InferenceRequest(prompt="warmup", max_length=10)
+
+    for length in WARMUP_PROMPT_LENGTHS:
+        length = max(1, min(length, max_positions - WARMUP_NEW_TOKENS - 1))
+        prompt_ids = (sample_ids * (length // len(sample_ids) + 1))[:length]
+        for batch_size in WARMUP_BATCH_SIZES:
+            await asyncio.gather(*(
+                served.engine.generate(prompt_ids, request, WARMUP_NEW_TOKENS) for _ in range(batch_size)
+            ))
+
+    # The streaming path has its own decode loop and buffers
+    async for _ in _stream_tokens(served, InferenceRequest(prompt=tokenizer.decode(sample_ids), max_length=10)):
+        pass
+
+async def warmup(served: ServedModel):
+    """Run warmup traffic; falls back to eager decode if the compiled graph fails."""
+    warmup_start = time.time()
+    engine = served.engine
+    # Synthetic prompts should not occupy the prefix cache
+    prefix_cache, engine.prefix_cache = engine.prefix_cache, None
+    try:
+        try:
+            await _run_warmup_traffic(served)
+        except Exception as e:
+            if served.decode_model is served.model:
+                raise
+            logger.warning(f"Compiled decode step failed during warmup, using eager mode: {e}")
+            served.set_decode_model(served.model)
+            await _run_warmup_traffic(served)
+    except Exception as e:
+        logger.warning(f"Warmup failed, serving cold: {e}")
+    finally:
+        engine.prefix_cache = prefix_cache
+
+    warmup_seconds = time.time() - warmup_start
+    WARMUP_SECONDS.labels(model=served.name).set(warmup_seconds)
+    logger.info(f"Warmup finished in {warmup_seconds:.2f}s")
+
+async def _load_and_start():
+    global model_loaded, model_ready, model_load_error
+    try:
+        served = await asyncio.get_running_loop().run_in_executor(None, load_model)
+    except Exception as e:
+        logger.error(f"Error loading model: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        model_load_error = str(e)
+        return
+    model_loaded = True
+
+    # Only MODEL_NAME is compiled - it is the one model warmed up before serving
+    if TORCH_COMPILE:
+        served.set_decode_model(_compile_decode_model(served.model))
+    await model_registry.add(served)
+    if kv_budget is not None:
+        # Admission counts tokens of every model at the default model's KV size (see _request_cost)
+        kv_budget.token_bytes = served.kv_pool.token_bytes
+        if ADMISSION_BUDGET_FROM_KV_CACHE:
+            # Admit as many such tokens as the shared KV budget holds, and streams
+            # as many as fit in their own allowance
+            admission.set_token_budget(kv_budget.capacity_tokens)
+            stream_admission.set_token_budget(int(STREAM_KV_CACHE_MAX_MB * 1024 ** 2 // kv_budget.token_bytes))
+
+    # Readiness waits for warmup so new replicas serve warm from their first request
+    if WARMUP_ENABLED:
+        await warmup(served)
+    model_ready = True
+    if server_processes_ready is not None:
+        server_processes_ready[SERVER_PROCESS_INDEX] = True
+    logger.info(f"Model {MODEL_NAME} is ready to serve")
+
+    if AMQP_CONSUMER_ENABLED:
+        await start_amqp_consumer()
+
+_startup_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_notification_hub():
+    notification_hub.start()
+
+@app.on_event("startup")
+async def start_model_loading():
+    # Threads and pinning are set before any weights are touched, so pages land on this process's node
+    apply_cpu_profile()
+    # Load in the background so /health answers while the weights load
+    global _startup_task
+    _startup_task = asyncio.get_running_loop().create_task(_load_and_start())
+
+@app.on_event("shutdown")
+async def stop_amqp_consumer():
+    if amqp_consumer is not None:
+        await amqp_consumer.stop()
+
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    start_time = time.time()
+    response = await call_next(request)
+    process_time = time.time() - start_time
+    logger.info(f"{request.method} {request.url.path} - {response.status_code} ({process_time:.2f}s)")
+    return response
+
+# Server Processes
+# One Python process serializes tokenization, sampling and request handling on
+# the GIL, so a CPU node is better used by several smaller processes, each
+# pinned to its own cores. They accept connections from one listening socket,
+# memory-map one copy of the weights (SNAPSHOT_DIR, written up front by a
+# throwaway process) and write their metrics to a shared directory that the
+# parent serves. Each reports readiness in a shared array, so every process
+# answers /ready for the whole pod. A process that dies is restarted.
+def _write_missing_snapshot():
+    """Convert MODEL_NAME and write its snapshot unless one exists."""
+    load_kwargs = _load_kwargs()
+    path = _snapshot_path(MODEL_NAME, load_kwargs["torch_dtype"])
+    if os.path.exists(os.path.join(path, SNAPSHOT_WEIGHTS)):
+        return
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, **load_kwargs)
+    _write_snapshot(model, tokenizer, path)
+    logger.info(f"Wrote model snapshot to {path}")
+
+def _run_server_process(sock, host: str, port: int, ready):
+    import uvicorn
+    global server_processes_ready
+    server_processes_ready = ready
+    uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=[sock])
+
+def serve_processes(processes: int, host: str, port: int):
+    """Run processes server processes on host:port until SIGTERM or SIGINT."""
+    import multiprocessing
+    import signal
+    import uvicorn
+    from prometheus_client import CollectorRegistry, multiprocess
+
+    context = multiprocessing.get_context("spawn")
+    if SNAPSHOT_DIR:
+        writer = context.Process(target=_write_missing_snapshot, name="snapshot-writer")
+        writer.start()
+        writer.join()
+        if writer.exitcode != 0:
+            logger.warning("Could not write the model snapshot, every process loads its own copy of the weights")
+    else:
+        logger.warning("SNAPSHOT_DIR is not set, every process loads its own copy of the weights")
+
+    # Server processes import prometheus_client with this set, so their metrics go to files served here
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="ml-metrics-")
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(8000, registry=registry)
+
+    sock = uvicorn.Config(app, host=host, port=port).bind_socket()
+    ready = context.Array("b", processes)
+    stopping = threading.Event()
+
+    def start(index: int):
+        ready[index] = False
+        os.environ["SERVER_PROCESS_INDEX"] = str(index)
+        process = context.Process(target=_run_server_process, args=(sock, host, port, ready), name=f"server-{index}")
+        process.start()
+        return process
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Starting {processes} server processes on port {port}...")
+    running = [start(index) for index in range(processes)]
+    while not stopping.wait(1):
+        for index, process in enumerate(running):
+            if not process.is_alive():
+                logger.warning(f"Server process {index} exited with code {process.exitcode}, restarting")
+                multiprocess.mark_process_dead(process.pid)
+                running[index] = start(index)
+    for process in running:
+        if process.is_alive():
+            process.terminate()
+    for process in running:
+        process.join()
+    sock.close()
+
+if __name__ == "__main__":
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", "8080"))
+    if SERVER_PROCESSES > 1:
+        serve_processes(SERVER_PROCESSES, host, port)
+    else:
+        import uvicorn
+        start_http_server(8000)
+        logger.info(f"Starting server on port {port}...")
+        uvicorn.run(app, host=host, port=port)
     
\ No newline at end of file
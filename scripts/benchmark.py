@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""
+Load-test and latency benchmark for the ML inference service.
+
+Drives /inference (non-streaming and streaming), /events and /notify at a
+configurable concurrency and arrival pattern and reports throughput, time to
+first token (TTFT), inter-token latency (ITL) and p50/p95/p99 latencies.
+Results are written as JSON so runs can be compared between releases.
+
+Without --url a tiny randomly initialised GPT-2 with a locally trained
+tokenizer is built and served by a local uvicorn process, so the benchmark
+runs fully offline on a CPU-only box:
+
+    python3 scripts/benchmark.py --output bench.json
+    python3 scripts/benchmark.py --scenarios stream --concurrency 8 --arrival poisson --rate 4
+    python3 scripts/benchmark.py --url http://localhost:8080 --scenarios inference,sse
+    python3 scripts/benchmark.py --baseline bench.json    # exit 1 on regressions
+
+--sweep restarts the local server for every combination of server processes,
+torch threads and inter-op threads (optionally pinned to cores) and reports
+throughput per core for each, to pick the CPU profile of a node:
+
+    python3 scripts/benchmark.py --sweep --sweep-processes 1,2,4 --sweep-threads 1,2,4 --sweep-pin
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_ROOT, "models", "inference")
+SCENARIOS = ("inference", "stream", "sse")
+ARRIVALS = ("closed", "poisson", "uniform", "burst")
+# Warmup requests use their own indices, so no measured request repeats a warmup prompt
+WARMUP_INDEX_OFFSET = 1_000_000
+
+# Words for the tiny tokenizer's training corpus and for benchmark prompts
+WORDS = (
+    "the model reads a prompt and writes an answer one token at a time while the queue "
+    "holds every request that waits for a batch slot on the server and each user sends "
+    "short questions or long documents about weather travel code music science history "
+    "food sport markets health and space so latency depends on prompt length batch size "
+    "and how many tokens are generated before the end of the sequence"
+).split()
+
+# Tiny model
+def build_tiny_model(path: str):
+    """Write a 2-layer GPT-2 and a byte-level BPE tokenizer to path (no downloads)."""
+    if os.path.exists(os.path.join(path, "config.json")):
+        return
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    eos = "<|endoftext|>"
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    rng = random.Random(0)
+    corpus = [" ".join(rng.choice(WORDS) for _ in range(64)) for _ in range(2000)]
+    bpe.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=1024, special_tokens=[eos], show_progress=False,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, bos_token=eos, eos_token=eos, unk_token=eos)
+
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=len(tokenizer), n_positions=512, n_embd=64, n_layer=2, n_head=2,
+        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id
+    )
+    model = GPT2LMHeadModel(config)
+    os.makedirs(path, exist_ok=True)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+# Local server
+def start_server(model_path: str, port: int, log_path: str, extra_env: Dict[str, str]) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "MODEL_NAME": model_path,
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "REDIS_URL": "",
+        "NOTIFY_BACKEND": "memory",
+        "AMQP_CONSUMER_ENABLED": "false",
+        # Every request must run the model; cache hits would inflate throughput and hide TTFT
+        "RESPONSE_CACHE_ENABLED": "false",
+        # One chunk per decode step, so chunk gaps are inter-token latencies
+        "STREAM_FLUSH_INTERVAL_MS": "0",
+        "STREAM_FLUSH_BYTES": "0",
+    })
+    env.update(extra_env)
+    env.update({"HOST": "127.0.0.1", "PORT": str(port)})
+    log = open(log_path, "w")
+    # app.py rather than uvicorn directly, so SERVER_PROCESSES can start several processes
+    return subprocess.Popen(
+        [sys.executable, "app.py"], cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def wait_until_ready(url: str, timeout: float, server: Optional[subprocess.Popen] = None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            if requests.get(f"{url}/ready", timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+# Load generation
+def arrival_offsets(count: int, pattern: str, rate: float, rng: random.Random) -> Optional[List[float]]:
+    """Send times relative to the start, or None for a closed loop (send as soon as a worker is free)."""
+    if pattern == "closed":
+        return None
+    if pattern == "burst":
+        return [0.0] * count
+    if pattern == "uniform":
+        return [i / rate for i in range(count)]
+    offsets, t = [], 0.0
+    for _ in range(count):
+        offsets.append(t)
+        t += rng.expovariate(rate)
+    return offsets
+
+def run_load(send: Callable[[int, float], dict], count: int, concurrency: int,
+             pattern: str, rate: float, seed: int) -> Tuple[List[dict], float]:
+    """
+    Call send(index, scheduled_at) count times on concurrency threads. With an
+    open-loop pattern, latencies count from the scheduled arrival, so requests
+    queued behind a saturated server are not hidden (coordinated omission).
+    """
+    offsets = arrival_offsets(count, pattern, rate, random.Random(seed))
+    results: List[dict] = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = []
+        for i in range(count):
+            if offsets is None:
+                futures.append(pool.submit(_timed, send, i, None))
+                continue
+            scheduled = start + offsets[i]
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(_timed, send, i, scheduled))
+        for future in futures:
+            results.append(future.result())
+    return results, time.perf_counter() - start
+
+def _timed(send, index: int, scheduled: Optional[float]) -> dict:
+    scheduled = time.perf_counter() if scheduled is None else scheduled
+    try:
+        result = send(index, scheduled)
+    except requests.exceptions.HTTPError as e:
+        result = {"error": str(e), "status": e.response.status_code}
+    except Exception as e:
+        result = {"error": str(e)}
+    result.setdefault("latency", time.perf_counter() - scheduled)
+    return result
+
+_sessions = threading.local()
+
+def _session() -> requests.Session:
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+def make_prompt(index: int, words: int, rng_seed: int, nonce: int = 0) -> str:
+    # The run nonce keeps prompts of repeated runs against one service out of its caches
+    rng = random.Random(f"{rng_seed}-{nonce}-{index}")
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+# Scenarios
+def inference_sender(args) -> Callable[[int, float], dict]:
+    def send(index: int, scheduled: float) -> dict:
+        payload = _payload(args, index, stream=False)
+        response = _session().post(f"{args.url}/inference", json=payload, timeout=args.timeout)
+        response.raise_for_status()
+        body = response.json()
+        return {"latency": time.perf_counter() - scheduled, "tokens": body["token_usage"]["completion_tokens"]}
+    return send
+
+def stream_sender(args) -> Callable[[int, float], dict]:
+    def send(index: int, scheduled: float) -> dict:
+        payload = _payload(args, index, stream=True)
+        response = _session().post(f"{args.url}/inference", json=payload, stream=True, timeout=args.timeout)
+        response.raise_for_status()
+        ttft, last, gaps, tokens = None, None, [], 0
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            now = time.perf_counter()
+            if chunk.get("token"):
+                if ttft is None:
+                    ttft = now - scheduled
+                else:
+                    gaps.append(now - last)
+                last = now
+            if chunk.get("is_finished"):
+                tokens = chunk["token_count"]["completion_tokens"]
+                break
+        return {"latency": time.perf_counter() - scheduled, "ttft": ttft, "itl": gaps, "tokens": tokens}
+    return send
+
+def sse_sender(args) -> Callable[[int, float], dict]:
+    """Open /events/{id}, POST /notify for it and time the delivery."""
+    def send(index: int, scheduled: float) -> dict:
+        request_id = f"bench-{uuid.uuid4()}"
+        events = requests.get(f"{args.url}/events/{request_id}", stream=True, timeout=args.timeout,
+                              headers={"Accept": "text/event-stream"})
+        events.raise_for_status()
+        lines = events.iter_lines()
+        try:
+            _next_event(lines)  # connected
+            notify_start = time.perf_counter()
+            response = _session().post(f"{args.url}/notify", timeout=args.timeout, json={
+                "request_id": request_id, "type": "completed", "result": "benchmark result"
+            })
+            response.raise_for_status()
+            notified = time.perf_counter()
+            while _next_event(lines).get("type") != "completed":
+                pass
+            delivered = time.perf_counter()
+        finally:
+            events.close()
+        return {"latency": delivered - scheduled, "notify": notified - notify_start, "delivery": delivered - notify_start}
+    return send
+
+def _next_event(lines) -> dict:
+    for line in lines:
+        if line.startswith(b"data: "):
+            return json.loads(line[len(b"data: "):])
+    raise RuntimeError("SSE stream ended")
+
+def _payload(args, index: int, stream: bool) -> dict:
+    payload = {
+        "prompt": make_prompt(index, args.prompt_words, args.seed, args.run_nonce),
+        "max_length": args.max_length,
+        "stream": stream,
+        "do_sample": not args.greedy,
+        "cache": False,
+        "user_id": f"bench-{index % args.users}",
+    }
+    # A seed makes the request cacheable, so it is only sent when asked for
+    if args.seeded:
+        payload["seed"] = args.seed + index
+    return payload
+
+SENDERS = {"inference": inference_sender, "stream": stream_sender, "sse": sse_sender}
+
+# Reporting
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def summarize(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values),
+    }
+
+def scenario_report(results: List[dict], duration: float) -> dict:
+    ok = [r for r in results if "error" not in r]
+    failed = [r for r in results if "error" in r]
+    tokens = sum(r.get("tokens", 0) for r in ok)
+    report = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(failed),
+        "rejected": sum(1 for r in failed if r.get("status") in (429, 503)),
+        "duration_s": duration,
+        "requests_per_s": len(ok) / duration if duration else 0.0,
+        "tokens_per_s": tokens / duration if duration else 0.0,
+        "latency_s": summarize([r["latency"] for r in ok]),
+        "ttft_s": summarize([r["ttft"] for r in ok if r.get("ttft") is not None]),
+        "itl_s": summarize([gap for r in ok for gap in r.get("itl", ())]),
+        "notify_s": summarize([r["notify"] for r in ok if "notify" in r]),
+        "delivery_s": summarize([r["delivery"] for r in ok if "delivery" in r]),
+    }
+    if failed:
+        report["first_error"] = failed[0]["error"]
+    return {key: value for key, value in report.items() if value is not None}
+
+def print_report(name: str, report: dict):
+    print(f"\n== {name}: {report['ok']}/{report['requests']} ok in {report['duration_s']:.2f}s "
+          f"| {report['requests_per_s']:.2f} req/s | {report['tokens_per_s']:.1f} tokens/s")
+    if report["errors"]:
+        print(f"   errors: {report['errors']} ({report['rejected']} rejected) - {report.get('first_error')}")
+    for key in ("latency_s", "ttft_s", "itl_s", "notify_s", "delivery_s"):
+        stats = report.get(key)
+        if stats:
+            print(f"   {key[:-2]:<9} p50 {stats['p50'] * 1000:9.1f} ms  p95 {stats['p95'] * 1000:9.1f} ms  "
+                  f"p99 {stats['p99'] * 1000:9.1f} ms  max {stats['max'] * 1000:9.1f} ms")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions beyond tolerance in throughput or p95 latencies against a baseline run."""
+    regressions = []
+    for name, report in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for key in ("requests_per_s", "tokens_per_s"):
+            if before.get(key) and report[key] < before[key] * (1 - tolerance):
+                regressions.append(f"{name} {key}: {before[key]:.2f} -> {report[key]:.2f}")
+        for key in ("latency_s", "ttft_s", "itl_s", "delivery_s"):
+            old, new = before.get(key), report.get(key)
+            if old and new and new["p95"] > old["p95"] * (1 + tolerance):
+                regressions.append(f"{name} {key} p95: {old['p95'] * 1000:.1f} ms -> {new['p95'] * 1000:.1f} ms")
+    return regressions
+
+# Runs
+def environment(url: str) -> dict:
+    health = requests.get(f"{url}/health", timeout=10).json()
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": health.get("model"),
+        "device": health.get("device"),
+        "quantization": health.get("quantization"),
+    }
+
+def run_scenarios(args, scenarios: List[str]) -> Dict[str, dict]:
+    """Warm up, load and report each scenario against args.url."""
+    reports = {}
+    for name in scenarios:
+        send = SENDERS[name](args)
+        if args.warmup:
+            def warmup_send(index: int, scheduled: float, send=send) -> dict:
+                return send(WARMUP_INDEX_OFFSET + index, scheduled)
+            run_load(warmup_send, args.warmup, args.concurrency, "closed", args.rate, args.seed)
+        scenario_results, duration = run_load(send, args.requests, args.concurrency,
+                                              args.arrival, args.rate, args.seed)
+        reports[name] = scenario_report(scenario_results, duration)
+        print_report(name, reports[name])
+    return reports
+
+# CPU sweep
+def sweep_settings(args) -> List[Dict[str, str]]:
+    """Server environments to sweep: every processes x threads x inter-op combination, pinned ones after each."""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    settings = []
+    for processes in args.sweep_processes:
+        for threads in args.sweep_threads:
+            for interop in args.sweep_interop:
+                env = {"SERVER_PROCESSES": str(processes), "TORCH_NUM_THREADS": str(threads),
+                       "TORCH_INTEROP_THREADS": str(interop)}
+                settings.append(env)
+                if args.sweep_pin and processes * threads <= len(available):
+                    cores = available[:processes * threads]
+                    settings.append(dict(env, CPU_AFFINITY=",".join(map(str, cores))))
+    return settings
+
+def cores_used(env: Dict[str, str]) -> int:
+    """Cores a sweep setting runs on: its pinned cores, else processes x threads within the machine."""
+    if env.get("CPU_AFFINITY"):
+        return len(env["CPU_AFFINITY"].split(","))
+    return max(1, min(int(env["SERVER_PROCESSES"]) * int(env["TORCH_NUM_THREADS"]), os.cpu_count()))
+
+def print_sweep(sweep: List[dict]):
+    print("\n== CPU sweep (per core = throughput / cores used)")
+    print(f"   {'processes':>9} {'threads':>7} {'interop':>7} {'pinned':>6} {'cores':>5}  {'scenario':<9} "
+          f"{'req/s':>8} {'req/s/core':>10} {'tokens/s':>9} {'tokens/s/core':>13}")
+    for run in sweep:
+        env = run["settings"]
+        for name, report in run["scenarios"].items():
+            print(f"   {env['SERVER_PROCESSES']:>9} {env['TORCH_NUM_THREADS']:>7} {env['TORCH_INTEROP_THREADS']:>7} "
+                  f"{'yes' if env.get('CPU_AFFINITY') else 'no':>6} {run['cores']:>5}  {name:<9} "
+                  f"{report['requests_per_s']:8.2f} {report['requests_per_s_per_core']:10.2f} "
+                  f"{report['tokens_per_s']:9.1f} {report['tokens_per_s_per_core']:13.1f}")
+
+def int_list(value: str) -> List[int]:
+    return [int(n) for n in value.split(",") if n.strip()]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ML inference service")
+    parser.add_argument("--url", help="Benchmark a running service instead of starting a local one")
+    parser.add_argument("--model", help="Model path for the local server (default: a tiny generated model)")
+    parser.add_argument("--model-dir", default=os.path.join(tempfile.gettempdir(), "ml-bench-tiny-model"),
+                        help="Where the tiny model is generated and cached")
+    parser.add_argument("--port", type=int, default=8089, help="Port for the local server")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the local server (repeatable)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {SCENARIOS}")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at most")
+    parser.add_argument("--arrival", choices=ARRIVALS, default="closed",
+                        help="closed: back-to-back per worker; poisson/uniform: --rate req/s; burst: all at once")
+    parser.add_argument("--rate", type=float, default=5.0, help="Arrival rate (req/s) for poisson and uniform")
+    parser.add_argument("--warmup", type=int, default=4, help="Unmeasured requests sent before each scenario")
+    parser.add_argument("--prompt-words", type=int, default=32, help="Words per generated prompt")
+    parser.add_argument("--max-length", type=int, default=64, help="max_length of each request")
+    parser.add_argument("--greedy", action="store_true", help="Decode greedily instead of sampling")
+    parser.add_argument("--seeded", action="store_true",
+                        help="Give every sampled request its own seed (--seed + index) for reproducible outputs")
+    parser.add_argument("--users", type=int, default=4, help="Distinct user_ids requests are spread over")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the prompts, arrivals and --seeded sampling")
+    parser.add_argument("--run-nonce", type=int, default=None,
+                        help="Varies the prompts between runs (default: random); fix it to replay a run's prompts")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--ready-timeout", type=float, default=300.0, help="Seconds to wait for /ready")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression vs --baseline")
+    parser.add_argument("--sweep", action="store_true",
+                        help="Restart the local server for every CPU setting below and report throughput per core")
+    parser.add_argument("--sweep-processes", type=int_list, default=[1, 2], help="SERVER_PROCESSES values to sweep")
+    parser.add_argument("--sweep-threads", type=int_list, default=[1, 2, 4], help="TORCH_NUM_THREADS values to sweep")
+    parser.add_argument("--sweep-interop", type=int_list, default=[1], help="TORCH_INTEROP_THREADS values to sweep")
+    parser.add_argument("--sweep-pin", action="store_true",
+                        help="Also run every setting pinned to its own cores (CPU_AFFINITY)")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.run_nonce is None:
+        args.run_nonce = random.SystemRandom().randrange(2 ** 32)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        return 2
+
+    if args.sweep and (args.url or args.baseline):
+        print("--sweep starts its own servers and cannot be combined with --url or --baseline")
+        return 2
+
+    server = None
+    if args.url is None:
+        model_path = args.model or args.model_dir
+        if args.model is None:
+            print(f"Preparing tiny model in {model_path}")
+            build_tiny_model(model_path)
+        model_path = os.path.abspath(model_path)
+        extra_env = dict(item.split("=", 1) for item in args.server_env)
+        log_path = os.path.join(tempfile.gettempdir(), f"ml-bench-server-{args.port}.log")
+        if not args.sweep:
+            print(f"Starting local server on port {args.port} (log: {log_path})")
+            server = start_server(model_path, args.port, log_path, extra_env)
+        args.url = f"http://127.0.0.1:{args.port}"
+    args.url = args.url.rstrip("/")
+    results = {
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+    }
+
+    if args.sweep:
+        # Server processes memory-map one snapshot of the weights instead of loading a copy each
+        extra_env.setdefault("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "ml-bench-snapshots"))
+        results["sweep"] = []
+        for settings in sweep_settings(args):
+            print(f"\nStarting local server with {settings} (log: {log_path})")
+            server = start_server(model_path, args.port, log_path, dict(extra_env, **settings))
+            try:
+                wait_until_ready(args.url, args.ready_timeout, server)
+                results.setdefault("environment", environment(args.url))
+                reports = run_scenarios(args, scenarios)
+            finally:
+                stop_server(server)
+            cores = cores_used(settings)
+            for report in reports.values():
+                report["requests_per_s_per_core"] = report["requests_per_s"] / cores
+                report["tokens_per_s_per_core"] = report["tokens_per_s"] / cores
+            results["sweep"].append({"settings": settings, "cores": cores, "scenarios": reports})
+        print_sweep(results["sweep"])
+    else:
+        try:
+            wait_until_ready(args.url, args.ready_timeout, server)
+            results["environment"] = environment(args.url)
+            results["scenarios"] = run_scenarios(args, scenarios)
+        finally:
+            if server is not None:
+                stop_server(server)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\nRegressions beyond {args.tolerance:.0%} against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())